@@ -0,0 +1,1966 @@
+# The pandoc-novel build script, run via build-book.py. Run that with the "-h" flag for brief help.
+# Documentation: https://github.com/mattgemmell/pandoc-novel/blob/main/README.org
+
+import re
+import argparse
+import os
+import glob
+import sys
+import datetime
+import json
+import time
+import threading
+import functools
+# Other modules (hashlib, signal, html, subprocess, concurrent.futures, urllib, zipfile, etc) are imported where used, to keep startup quick.
+
+
+# --- Globals ---
+
+default_args_filename = "args.txt"
+default_metadata_filename = "metadata.json"
+default_exclusions_filename = "exclusions.tsv"
+default_transformations_filename = "transformations.tsv"
+master_basename = "collated-book-master"
+# Shared by all books, so books in a series can reuse each other's work on the same chapters.
+default_cache_folder_path = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "pandoc-novel", "build-cache")
+default_cache_max_size = 1024 # MB
+# Part of every stage's cache key. Bump it whenever cached stage output changes meaning, so older output is ignored.
+stage_cache_version = 2
+tk_pattern = r"(?i)\b(TK)+\b"
+valid_placeholder_modes = ["basic", "templite", "jinja2"] # or "none"
+valid_output_formats = ["epub", "pdf", "pdf-6x9", "html", "html-chunked"] # or "all"
+chunked_index_filename = "index.html"
+draft_output_formats = ["html", "pdf", "pdf-6x9", "html-chunked"]
+draft_image_max_size = 600 # pixels
+# Surround a draft range while the whole book is processed, so the range can be found again.
+draft_range_start_marker = "<!-- pandoc-novel draft range start -->"
+draft_range_end_marker = "<!-- pandoc-novel draft range end -->"
+default_read_workers = 8
+default_pandoc_server_port = 3030
+pandoc_server_startup_timeout = 10 # seconds
+pandoc_server_request_timeout = 300 # seconds, after which we fall back to the pandoc executable
+font_file_extensions = (".ttf", ".otf", ".woff", ".woff2")
+# Rough peak memory use (MB) of building each format, as a base amount plus an amount per MB of manuscript.
+# PDFs are by far the hungriest, since WeasyPrint lays out the whole book at once.
+format_memory_estimates = {"epub": (150, 100), "html": (150, 100), "html-chunked": (150, 100), "pdf": (300, 1500), "pdf-6x9": (300, 1500)}
+default_memory_budget_fraction = 0.8 # of memory available when the build starts
+max_format_attempts = 3
+# Signs in pandoc's error output that it (or its PDF engine, e.g. WeasyPrint raising MemoryError) ran out of memory.
+out_of_memory_regex = re.compile(r"\bMemoryError\b|\bout of memory\b|\bheap overflow\b|Cannot allocate memory", re.IGNORECASE)
+# Defaults-file keys which only make sense for the pandoc executable, so aren't sent to pandoc server.
+pandoc_server_ignored_keys = ["verbosity", "pdf-engine", "pdf-engine-opt", "output-file"]
+verbose_mode = False
+show_pandoc_commands = False
+use_cache = True
+cache_folder_path = None
+cache_stats = {}
+cache_stats_lock = threading.Lock()
+rule_time_budget = 0
+rule_budget_action = "error"
+valid_rule_budget_actions = ["error", "skip"]
+rule_costs = {}
+skipped_rules = set()
+pandoc_server_lock = threading.Lock()
+pandoc_server_checked = False
+pandoc_server_available = False
+pandoc_server_process = None
+memory_budget = 0 # MB, or 0 for no limit
+memory_reserved = 0
+memory_condition = threading.Condition()
+pattern_metadata_flag = "M"
+pattern_negate_flag = "N"
+pattern_flag_regex = r"^\(\?[a-zA-Z]*({pattern_flag})[^\)]*\)"
+pattern_metadata_key_regex = rf"\%([^\%]+?)\%"
+# Slug and heading patterns, compiled once since they're applied to every heading in the book.
+slug_quotes_regex = re.compile(r'[\'"“”‘’]+')
+slug_nonword_regex = re.compile(r'\W+')
+slug_whitespace_regex = re.compile(r'\s+')
+heading_regex = re.compile(r'^(#{1,6})[ \t]+(.+)', re.MULTILINE)
+code_fence_regex = re.compile(r'^(`{3,}|~{3,}).*?^\1[ \t]*$', re.MULTILINE | re.DOTALL)
+heading_id_regex = re.compile(r"\{.*?#(\S+).*?\}")
+heading_formatting_regex = re.compile(r'[_*`#]')
+heading_emphasis_regex = re.compile(r'[*`]|(?<!\w)_+|_+(?!\w)')
+heading_closing_hashes_regex = re.compile(r'[ \t]+#+$')
+heading_link_regex = re.compile(r'\[([^\]]+)\]\([^)]+\)')
+heading_attributes_regex = re.compile(r'{[^\}]+}\s*$')
+heading_unlisted_regex = re.compile(r"(?i)\.(no-?toc|unlisted)\b")
+heading_footnote_regex = re.compile(r'\[\^[^\]]+\]')
+heading_html_tag_regex = re.compile(r'<[^>]+>')
+heading_smart_dash_regex = re.compile(r'-{2,3}')
+identifier_disallowed_regex = re.compile(r'[^\w\s-]')
+identifier_whitespace_regex = re.compile(r'\s')
+
+# --- Functions ---
+
+def inform(msg, severity="normal", force=False):
+	should_echo = (force or verbose_mode or severity=="warning" or severity=="error")
+	if should_echo:
+		out = ""
+		match severity:
+			case "warning":
+				out = f"[Warning]: {msg}"
+			case "error":
+				out = f"[ERROR]: {msg}"
+				should_echo = True
+			case _:
+				out = msg
+		print(out)
+
+def pattern_has_flag(patt, flag):
+	return re.match(f"{pattern_flag_regex.format(pattern_flag = flag)}", patt)
+
+def pattern_strip_flag(patt, flag):
+	# Remove the pattern flag from this pattern.
+	flag_match = pattern_has_flag(patt, flag)
+	if flag_match:
+		return patt[:flag_match.start(1)] + patt[flag_match.end(1):]
+	return patt
+
+def sorted_alphanumeric(data):
+	# Sorts lexicographically; natural numeric then alphabetical.
+	convert = lambda text: int(text) if text.isdigit() else text.lower()
+	alphanum_key = lambda key: [ convert(c) for c in re.split('([0-9]+)', key) ] 
+	return sorted(data, key=alphanum_key)
+
+class RuleBudgetExceeded(Exception):
+	pass
+
+def rule_budget_alarm(signum, frame):
+	raise RuleBudgetExceeded()
+
+def run_rule(rule_source, target, operation):
+	# Runs a user-supplied regular expression operation over target, recording its cost against rule_source.
+	# 	operation: callable performing the regex work, returning (result, number of matches)
+	# Raises RuleBudgetExceeded if the rule's cumulative time exceeds rule_time_budget.
+	import signal
+	costs = rule_costs.setdefault(rule_source, {"seconds": 0.0, "matches": 0, "bytes": 0, "cached": 0})
+	use_alarm = False
+	if rule_time_budget > 0:
+		budget_remaining = rule_time_budget - costs["seconds"]
+		if budget_remaining <= 0:
+			raise RuleBudgetExceeded()
+		# Python's regex engine checks for signals while matching, so an alarm can interrupt a runaway pattern.
+		# Alarms are only available on the main thread of Unix-like systems; elsewhere, the budget is checked afterwards.
+		try:
+			previous_handler = signal.signal(signal.SIGALRM, rule_budget_alarm)
+			signal.setitimer(signal.ITIMER_REAL, budget_remaining)
+			use_alarm = True
+		except (AttributeError, ValueError):
+			pass
+	
+	start_time = time.perf_counter()
+	try:
+		result, num_matches = operation()
+	finally:
+		if use_alarm:
+			signal.setitimer(signal.ITIMER_REAL, 0)
+			signal.signal(signal.SIGALRM, previous_handler)
+		costs["seconds"] += time.perf_counter() - start_time
+		costs["bytes"] += len(target.encode("utf-8"))
+	
+	costs["matches"] += num_matches
+	if rule_time_budget > 0 and costs["seconds"] > rule_time_budget:
+		raise RuleBudgetExceeded()
+	return result
+
+def rule_search(rule_source, pattern, target):
+	def operation():
+		found = re.search(pattern, target)
+		return found, (1 if found else 0)
+	return run_rule(rule_source, target, operation)
+
+def rule_subn(rule_source, pattern, replacement, target):
+	return run_rule(rule_source, target, lambda: re.subn(pattern, replacement, target))
+
+def record_cached_rule_result(rule_source, found):
+	# Count a rule's result reused from the cache (which cost no time or scanning) in its costs.
+	costs = rule_costs.setdefault(rule_source, {"seconds": 0.0, "matches": 0, "bytes": 0, "cached": 0})
+	costs["matches"] += 1 if found else 0
+	costs["cached"] += 1
+
+def rule_budget_exceeded(rule_source, pattern):
+	# Stops the build, or disables the rule for the rest of the build, per rule_budget_action.
+	msg = f"Rule at {rule_source} exceeded its time budget of {rule_time_budget}s: \"{pattern}\""
+	if rule_budget_action == "skip":
+		inform(f"{msg}. Skipping this rule for the rest of the build.", severity="warning")
+		skipped_rules.add(rule_source)
+	else:
+		inform(f"{msg}. Not continuing. (Use --rule-budget-action skip to skip such rules instead.)", severity="error")
+		sys.exit(1)
+
+def report_rule_costs():
+	# Show time spent, matches found, and bytes scanned by each user-supplied rule, slowest first.
+	if len(rule_costs) == 0:
+		return
+	lines = []
+	for rule_source, costs in sorted(rule_costs.items(), key=lambda item: item[1]["seconds"], reverse=True):
+		skipped = " (skipped: over budget)" if rule_source in skipped_rules else ""
+		cached = f", {costs['cached']} result{'s' if costs['cached'] != 1 else ''} reused from cache" if costs["cached"] > 0 else ""
+		lines.append(f"- {rule_source}: {costs['seconds']:.4f}s, {costs['matches']} match{'es' if costs['matches'] != 1 else ''}, {costs['bytes']:,} bytes scanned{cached}{skipped}")
+	lines_string = '\n'.join(lines)
+	inform(f"Regular expression rule costs (slowest first):\n{lines_string}", force=True)
+
+def make_draft_image_proxies(text):
+	# Replace local Markdown images with small, low-quality copies for quick previews. Requires Pillow.
+	try:
+		from PIL import Image
+	except ImportError as e:
+		inform(f"Couldn't find Pillow (PIL) module, so using full-size images: {e}", severity="warning")
+		return text
+	proxy_folder = os.path.join(cache_folder_path, "draft-images")
+	proxies = {}
+	for image_path in set(re.findall(r"!\[[^\]]*\]\(<?([^)\s>]+)", text)):
+		if not os.path.isfile(image_path):
+			continue
+		proxy_path = os.path.join(proxy_folder, f"{file_hash(image_path)}.jpg")
+		if os.path.isfile(proxy_path):
+			os.utime(proxy_path)
+		else:
+			try:
+				os.makedirs(proxy_folder, exist_ok=True)
+				with Image.open(image_path) as image:
+					image.thumbnail((draft_image_max_size, draft_image_max_size))
+					image.convert("RGB").save(proxy_path, "JPEG", quality=60)
+			except (IOError, ValueError) as e:
+				inform(f"Couldn't make draft proxy for image {image_path}: {e}", severity="warning")
+				continue
+		proxies[image_path] = proxy_path
+	for image_path, proxy_path in proxies.items():
+		text = re.sub(rf"(!\[[^\]]*\]\(<?){re.escape(image_path)}(?=[)\s>])", lambda m: f"{m.group(1)}{proxy_path}", text)
+	inform(f"- Using low-resolution proxies for {len(proxies)} image{'s' if len(proxies) != 1 else ''}.")
+	return text
+
+def read_text_file(path):
+	with open(path, 'r') as text_file:
+		return text_file.read()
+
+def content_hash(*parts):
+	# Returns a stable hex digest of the given strings (or bytes), for use as a cache key.
+	import hashlib
+	digest = hashlib.sha256()
+	for part in parts:
+		if isinstance(part, str):
+			part = part.encode("utf-8")
+		digest.update(part)
+		digest.update(b"\0")
+	return digest.hexdigest()
+
+def file_hash(path):
+	# Returns a hex digest of a file's contents, or an empty string if it can't be read.
+	try:
+		with open(path, 'rb') as hashed_file:
+			return content_hash(hashed_file.read())
+	except (IOError, TypeError):
+		return ""
+
+def cache_entry_path(stage, key):
+	return os.path.join(cache_folder_path, stage, f"{key}.cache")
+
+def cache_read(stage, key, record_stats=True):
+	# Returns previously-cached output for this stage and key, or None.
+	if not use_cache or not cache_folder_path:
+		return None
+	entry_path = cache_entry_path(stage, key)
+	try:
+		with open(entry_path, 'r') as cached_file:
+			contents = cached_file.read()
+		# Mark the entry as recently used, so it's among the last to be evicted.
+		os.utime(entry_path)
+	except IOError:
+		contents = None
+	if record_stats:
+		with cache_stats_lock:
+			stage_stats = cache_stats.setdefault(stage, {"hits": 0, "misses": 0})
+			stage_stats["hits" if contents is not None else "misses"] += 1
+	return contents
+
+def cache_write(stage, key, contents):
+	# Stores output for this stage and key. Failure to cache is never fatal.
+	if not use_cache or not cache_folder_path:
+		return
+	entry_path = cache_entry_path(stage, key)
+	temp_path = f"{entry_path}.{os.getpid()}.tmp"
+	try:
+		os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+		with open(temp_path, 'w') as cached_file:
+			cached_file.write(contents)
+		os.replace(temp_path, entry_path)
+	except IOError as e:
+		inform(f"Couldn't write {stage} cache entry: {e}", severity="warning")
+
+def prune_cache(max_size):
+	# Evict the least recently used cache entries until the cache is no larger than max_size (MB).
+	# Returns (number of entries removed, cache size in bytes afterwards).
+	entries = []
+	for folder, subfolders, filenames in os.walk(cache_folder_path):
+		for filename in filenames:
+			# Only touch files we made, in case the cache folder is shared with anything else.
+			if not (filename.endswith(".cache") or os.path.basename(folder) == "draft-images"):
+				continue
+			entry_path = os.path.join(folder, filename)
+			try:
+				entry_stat = os.stat(entry_path)
+			except OSError:
+				continue
+			entries.append((entry_stat.st_mtime, entry_stat.st_size, entry_path))
+	total_size = sum(entry[1] for entry in entries)
+	num_removed = 0
+	for mtime, size, entry_path in sorted(entries):
+		if total_size <= max_size * 1024 * 1024:
+			break
+		try:
+			os.remove(entry_path)
+			total_size -= size
+			num_removed += 1
+		except OSError:
+			pass
+	return num_removed, total_size
+
+def report_cache_stats():
+	# Show how often each kind of cached output was reused.
+	if len(cache_stats) == 0:
+		return
+	lines = []
+	for stage, stats in sorted(cache_stats.items()):
+		lookups = stats["hits"] + stats["misses"]
+		lines.append(f"- {stage}: {stats['hits']} of {lookups} reused ({stats['hits'] / lookups * 100:.0f}%)")
+	lines_string = '\n'.join(lines)
+	inform(f"Cache hit rates ({cache_folder_path}):\n{lines_string}", force=True)
+
+def file_signature(path):
+	# Cheap stand-in for a file's contents, which changes whenever they do in practice: its size and modification time.
+	try:
+		file_stat = os.stat(path)
+		return f"{file_stat.st_size}:{file_stat.st_mtime_ns}"
+	except (OSError, TypeError):
+		return ""
+
+def stage_node(name, run, deps=[], inputs=None, cacheable=True, valid=None):
+	# Describes one build stage, for run_stages.
+	# 	run: callable taking a dict of its dependencies' outputs (by stage name), returning its own JSON-compatible output
+	# 	deps: names of stages whose outputs this stage uses
+	# 	inputs: callable taking the same dict, returning everything else the stage reads (file hashes, settings, metadata, etc)
+	# 	cacheable: if False, the stage always runs, e.g. because it reports to the user, or writes a file other stages need
+	# 	valid: callable checking whether a cached output is still usable, e.g. its output file hasn't since been changed
+	return {"name": name, "run": run, "deps": deps, "inputs": inputs, "cacheable": cacheable, "valid": valid}
+
+def run_stage(node, dep_outputs, dep_hashes):
+	# Runs one stage, or reuses its cached output if none of its inputs have changed. Returns (output, explanation).
+	if not node["cacheable"]:
+		return node["run"](dep_outputs), "ran: always runs"
+	inputs = node["inputs"](dep_outputs) if node["inputs"] else {}
+	inputs.update({f"stage:{dep}": dep_hashes[dep] for dep in node["deps"]})
+	input_hashes = {key: content_hash(json.dumps(value, sort_keys=True)) for key, value in inputs.items()}
+	cache_key = content_hash(str(stage_cache_version), node["name"], json.dumps(input_hashes, sort_keys=True))
+	# Remember each stage's last inputs for this book, to explain what changed.
+	manifest_key = content_hash("manifest", node["name"], os.getcwd())
+	
+	cached = cache_read("stages", cache_key)
+	if cached is not None:
+		output = json.loads(cached)
+		if node["valid"] is None or node["valid"](output):
+			cache_write("manifests", manifest_key, json.dumps(input_hashes))
+			return output, "skipped: inputs unchanged"
+		explanation = "ran: previous output is missing or was changed"
+	elif not use_cache:
+		explanation = "ran: caching disabled"
+	else:
+		previous = cache_read("manifests", manifest_key, record_stats=False)
+		previous_hashes = json.loads(previous) if previous else None
+		if not previous_hashes:
+			explanation = "ran: no previous run"
+		else:
+			changed = [key for key in input_hashes if previous_hashes.get(key) != input_hashes[key]]
+			changed += [key for key in previous_hashes if key not in input_hashes]
+			explanation = f"ran: changed inputs: {', '.join(changed)}" if len(changed) > 0 else "ran: no cached output"
+	
+	output = node["run"](dep_outputs)
+	cache_write("stages", cache_key, json.dumps(output))
+	cache_write("manifests", manifest_key, json.dumps(input_hashes))
+	return output, explanation
+
+def run_stages(nodes, max_workers=1, explain=False):
+	# Runs build stages in dependency order, concurrently where they're independent. Returns their outputs by stage name.
+	import concurrent.futures
+	pending = {node["name"]: node for node in nodes}
+	outputs = {}
+	output_hashes = {}
+	running = {}
+	
+	def finished(node, output, explanation, start_time):
+		outputs[node["name"]] = output
+		output_hashes[node["name"]] = content_hash(json.dumps(output, sort_keys=True))
+		if explain:
+			inform(f"- {node['name']}: {explanation} ({time.perf_counter() - start_time:.2f}s)", force=True)
+	
+	with concurrent.futures.ThreadPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+		while len(pending) > 0 or len(running) > 0:
+			ready = [node for node in pending.values() if all(dep in outputs for dep in node["deps"])]
+			if len(ready) == 1 and len(running) == 0:
+				# Run lone stages on this thread, where rule time budgets can interrupt runaway patterns.
+				node = pending.pop(ready[0]["name"])
+				start_time = time.perf_counter()
+				output, explanation = run_stage(node, {dep: outputs[dep] for dep in node["deps"]}, output_hashes)
+				finished(node, output, explanation, start_time)
+				continue
+			for node in ready:
+				del pending[node["name"]]
+				running[executor.submit(run_stage, node, {dep: outputs[dep] for dep in node["deps"]}, output_hashes)] = (node, time.perf_counter())
+			if len(running) == 0:
+				raise ValueError(f"build stages have missing or circular dependencies: {', '.join(pending)}")
+			done, not_done = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+			for future in done:
+				node, start_time = running.pop(future)
+				output, explanation = future.result()
+				finished(node, output, explanation, start_time)
+	return outputs
+
+@functools.lru_cache(maxsize=None)
+def string_to_slug(text):
+	# Strip quotes
+	text = slug_quotes_regex.sub('', text)
+	
+	# Replace non-alphanumeric characters with whitespace
+	text = slug_nonword_regex.sub(' ', text)
+	
+	# Replace whitespace runs with single hyphens
+	text = slug_whitespace_regex.sub('-', text)
+	
+	# Remove leading and trailing hyphens
+	text = text.strip('-')
+	
+	# Return in lowercase
+	return text.lower()
+
+@functools.lru_cache(maxsize=None)
+def heading_identifier(plain_title):
+	# Returns the identifier pandoc will automatically give a heading with this (plain-text) title.
+	# Follows pandoc's gfm_auto_identifiers algorithm, as used by our commonmark_x input format: lowercase, then
+	# each whitespace character becomes a hyphen, and punctuation other than hyphens and underscores is removed.
+	# Our "smart" extension turns -- and --- into en and em dashes first, which are then removed as punctuation.
+	identifier = heading_smart_dash_regex.sub('', plain_title).lower()
+	identifier = identifier_whitespace_regex.sub('-', identifier)
+	identifier = identifier_disallowed_regex.sub('', identifier)
+	return identifier if identifier != "" else "section"
+
+@functools.lru_cache(maxsize=None)
+def parse_heading_title(title):
+	# Returns (clean title, explicit identifier or None, automatic identifier, unlisted) for a heading's Markdown title.
+	
+	# Try to extract an #id attribute.
+	id_match = heading_id_regex.search(title)
+	id_override = None
+	if id_match:
+		id_override = id_match.group(1)
+	
+	# Remove any Markdown formatting from title (e.g. inline code, emphasis, links).
+	clean_title = heading_formatting_regex.sub('', title)
+	# Remove Markdown links, keep text.
+	clean_title = heading_link_regex.sub(r'\1', clean_title).strip()
+	# Remove trailing attribute strings.
+	clean_title = heading_attributes_regex.sub('', clean_title).strip()
+	
+	# pandoc makes identifiers from the title's text, ignoring footnotes and raw HTML. Only emphasis and code markers are
+	# removed from that text, since underscores within words (e.g. "snake_case") aren't emphasis, and are kept.
+	plain_title = heading_emphasis_regex.sub('', title)
+	plain_title = heading_attributes_regex.sub('', heading_link_regex.sub(r'\1', plain_title).strip()).strip()
+	plain_title = heading_closing_hashes_regex.sub('', plain_title)
+	identifier = heading_identifier(heading_html_tag_regex.sub('', heading_footnote_regex.sub('', plain_title)).strip())
+	
+	# Headings marked with .no-toc or .unlisted class (presumably in an attribute string) are left out of ToCs.
+	unlisted = bool(heading_unlisted_regex.search(title))
+	return clean_title, id_override, identifier, unlisted
+
+def heading_anchor_table(markdown_text):
+	# Find every heading in markdown_text, in order, with the anchor pandoc will give it.
+	# Returns a list of dicts with keys pos (offset of heading in markdown_text), level, title, anchor, and unlisted.
+	# Like pandoc's commonmark_x reader, explicit identifiers are used as-is, and automatic identifiers are counted per
+	# identifier: the first use of each is left alone, and later uses get "-1", "-2", etc appended, even if that matches
+	# another heading's identifier (so "Scene", "Scene", "Scene 1" become scene, scene-1, scene-1). Explicit identifiers
+	# aren't counted. Lines inside fenced code blocks aren't headings.
+	import bisect
+	fence_spans = [(fence_match.start(), fence_match.end()) for fence_match in code_fence_regex.finditer(markdown_text)]
+	fence_starts = [span[0] for span in fence_spans]
+	identifier_counts = {}
+	table = []
+	for heading_match in heading_regex.finditer(markdown_text):
+		pos = heading_match.start()
+		fence_index = bisect.bisect_right(fence_starts, pos) - 1
+		if fence_index >= 0 and pos < fence_spans[fence_index][1]:
+			continue
+		clean_title, id_override, anchor, unlisted = parse_heading_title(heading_match.group(2))
+		if id_override:
+			anchor = id_override
+		else:
+			count = identifier_counts.get(anchor, 0)
+			identifier_counts[anchor] = count + 1
+			if count > 0:
+				anchor = f"{anchor}-{count}"
+		table.append({"pos": pos, "level": len(heading_match.group(1)), "title": clean_title, "anchor": anchor, "unlisted": unlisted})
+	return table
+
+def generate_toc(markdown_text, start=1, depth=3, ordered=True, plain=False, output="markdown", classes=[], anchor_table=None, from_pos=0):
+	
+	# Generate a hierarchical table of contents for Markdown (atx-style, hash-prefixed) headings.
+	# 	markdown_text: full Markdown contents of document
+	# 	start: shallowest heading-level to include
+	# 	depth: deepest heading-level to include
+	# 	ordered: if True, ordered ("1." etc) list, else unordered ("-")
+	# 	plain: if True, omit all CSS classes, and the .page-number links for each entry
+	# 	output: "markdown" (nested list, uses attribute-list syntax for classes) or "html"
+	# 	classes: CSS classes (without leading period) to apply to overall list
+	# 	anchor_table: headings of markdown_text, from heading_anchor_table (built here if not supplied)
+	# 	from_pos: only include headings from this offset in markdown_text onwards
+	
+	
+	# Find all headings.
+	if anchor_table is None:
+		anchor_table = heading_anchor_table(markdown_text)
+	headings = [heading for heading in anchor_table if heading["pos"] >= from_pos and int(start) <= heading["level"] <= int(depth)]
+	if not headings:
+		return ""
+	
+	toc_lines = []
+	prev_level = 0
+	numbers_stack = [0]
+	list_marker = "-" # fallback for Markdown-format level-jump compensation.
+	as_html = (output.lower() != "markdown")
+	tag_name = "ol" if ordered else "ul"
+	tag_start, tag_end = f"<{tag_name}>", f"</{tag_name}>"
+	i = 0
+	num_headings = len(headings)
+	
+	for heading in headings:
+		first = (i == 0)
+		last = (i == num_headings - 1)
+		clean_title = heading["title"]
+		slug = heading["anchor"]
+		
+		# Skip headings marked with .no-toc or .unlisted class (presumably in an attribute string).
+		if heading["unlisted"]:
+			continue
+		
+		level = heading["level"] - int(start) # root-level list items are level 0, etc.
+		indent = "\t" * level
+		
+		if level > prev_level and (level - prev_level > 1 or first):
+			inform(f"ToC entry jumps from heading level {prev_level + 1} to {level + 1}: {clean_title}", severity="warning")
+			# We skipped levels. Fill in.
+			range_start = prev_level if first else prev_level + 1
+			for x in range(range_start, level): # ranges exclude the final value
+				indent = "\t" * (x if first else (x - 1))
+				if as_html:
+					if first:
+						toc_lines.append("")
+					toc_lines.append(f"{indent}\t{tag_start}\n{indent}\t\t<li>")
+				else:
+					toc_lines.append(f"{indent}- &nbsp;")
+			if first:
+				indent += "\t"
+		elif as_html and level > prev_level:
+			toc_lines.append(f"{indent}{tag_start}\n{indent}\t<li>")
+		elif as_html and level == prev_level:
+			if not first:
+				toc_lines[-1] += f"</li>"
+				toc_lines.append(f"{indent}\t<li>")
+		elif as_html: # level < prev_level; decreasing depth.
+			for x in range(level, prev_level):
+				indent = "\t" * x
+				toc_lines[-1] += f"</li>"
+				toc_lines.append(f"{indent}\t{tag_end}")
+			toc_lines.append(f"{indent}\t</li>")
+			toc_lines.append(f"{indent}\t<li>")
+		
+		# Manage numbers for ordered Markdown lists.
+		if ordered:
+			if level == prev_level:
+				numbers_stack[-1] += 1
+			elif level > prev_level:
+				for x in range(prev_level, level):
+					numbers_stack.append(1)
+			else:
+				for x in range(level, prev_level):
+					numbers_stack.pop()
+			list_marker = f"{numbers_stack[-1]}."
+		
+		if as_html:
+			if first and len(toc_lines) == 0:
+				toc_lines.append("")
+			if plain:
+				toc_lines[-1] += f'<a href="#{slug}">{clean_title}</a>'
+			else:
+				toc_lines[-1] += f'<a href="#{slug}" class="section-title">{clean_title}</a><a href="#{slug}" class="page-number"></a>'
+		else:
+			if plain:
+				toc_lines.append(f"{indent}{list_marker} [{clean_title}](#{slug})")
+			else:
+				toc_lines.append(f"{indent}{list_marker} [{clean_title}](#{slug}){{.section-title}}[](#{slug}){{.page-number}}")
+		
+		prev_level = level
+		i += 1
+	
+	if as_html and prev_level > 0:
+		for x in range(0, prev_level):
+			indent = "\t" * (x - 1)
+			toc_lines.append(f"{indent}\t\t</li>\n{indent}\t{tag_end}\n")
+	
+	toc = f"{'\n'.join(toc_lines)}"
+	classes.append("toc")
+	if as_html:
+		if plain:
+			toc = f"{tag_start}\n\t<li>{toc}{indent}</li>\n{tag_end}"
+		else:
+			toc = f"<{tag_name} class=\"{' '.join(classes)}\">\n\t<li>{toc}{indent}</li>\n{tag_end}"
+	elif not plain:
+			toc = f"{{.{' .'.join(classes)}}}\n{toc}"
+	
+	#print(f"###\n{toc}###\n")
+	return toc
+
+
+def process_toc(text, context=None, context_offset=0):
+	# Replace every ToC directive in text with a suitable ToC.
+	# 	context: if text is only part of the book (e.g. in a draft build), the whole book, with text beginning at context_offset.
+	toc_pattern = r"(?im)^{toc(?:\s+([^\}]+?)\s*)?}"
+	if not re.search(toc_pattern, text):
+		return text
+	# Find the book's headings and their anchors once, for all ToCs.
+	anchor_table = heading_anchor_table(context if context is not None else text)
+	return re.sub(toc_pattern, lambda the_match: toc_replace(the_match, context, context_offset, anchor_table), text)
+
+
+def toc_replace(the_match, context=None, context_offset=0, anchor_table=None):
+	# Parse params for this ToC.
+	start_pos = the_match.end()
+	depth = 3
+	start_depth = 1
+	classes = []
+	ordered = True
+	plain = False
+	output = "markdown"
+	
+	if the_match.group(1):
+		depth_match = re.search(r"(?i)depth=['\"]?(\d+)['\"]?", the_match.group(1))
+		if depth_match and depth_match.group(1):
+			depth = int(depth_match.group(1))
+		start_depth_match = re.search(r"(?i)start=['\"]?(\d+)['\"]?", the_match.group(1))
+		if start_depth_match and start_depth_match.group(1):
+			start_depth = int(start_depth_match.group(1))
+			start_depth = max(start_depth, 1)
+		if re.search(r"(?i)\b(?<!\.)all\b", the_match.group(1)):
+			start_pos = 0
+		if re.search(r"(?i)\b(?<!\.)unordered\b", the_match.group(1)):
+			ordered = False
+		if re.search(r"(?i)\b(?<!\.)plain\b", the_match.group(1)):
+			plain = True
+		for this_class in re.finditer(r"\.(\S+)", the_match.group(1)):
+			classes.append(this_class.group(1))
+		output_match = re.search(r"(?i)output=['\"]?(\S+)['\"]?", the_match.group(1))
+		if output_match and output_match.group(1):
+			output = output_match.group(1)
+	
+	# Find headings in the whole book where possible, so partial builds get the same ToC.
+	headings_source = the_match.string
+	if context is not None:
+		headings_source = context
+		if start_pos > 0:
+			start_pos += context_offset
+	return generate_toc(headings_source, depth=depth, start=start_depth, classes=classes, ordered=ordered, plain=plain, output=output, anchor_table=anchor_table, from_pos=start_pos)
+
+
+def read_pandoc_defaults(path):
+	# Read a pandoc defaults file into a dict, expanding ${.} to the file's own folder.
+	# Handles only the flat subset of YAML used by our options files: "key: value" lines and "- item" lists.
+	defaults = {}
+	list_key = None
+	defaults_folder = os.path.dirname(os.path.abspath(path))
+	with open(path, 'r') as defaults_file:
+		for line in defaults_file:
+			line = line.rstrip()
+			if line.strip() in ["", "---", "..."] or line.lstrip().startswith("#"):
+				continue
+			line = line.replace("${.}", defaults_folder)
+			item_match = re.match(r"^\s+-\s+(.+)$", line)
+			if item_match and list_key:
+				defaults[list_key].append(item_match.group(1).strip("'\""))
+				continue
+			key_match = re.match(r"^([\w-]+):\s*(.*)$", line)
+			if key_match:
+				key, value = key_match.group(1), key_match.group(2).strip("'\"")
+				list_key = None
+				if value == "":
+					defaults[key] = []
+					list_key = key
+				elif value in ["true", "false"]:
+					defaults[key] = (value == "true")
+				else:
+					defaults[key] = value
+	return defaults
+
+def pandoc_server_url(port, path=""):
+	return f"http://127.0.0.1:{port}/{path}"
+
+def pandoc_server_ready(port):
+	import urllib.request
+	try:
+		with urllib.request.urlopen(pandoc_server_url(port, "version"), timeout=1) as response:
+			return response.status == 200
+	except OSError:
+		return False
+
+def start_pandoc_server(port):
+	# Use a pandoc server already listening on port, or start one. Returns (available, process we started or None).
+	import subprocess
+	if pandoc_server_ready(port):
+		inform(f"Using running pandoc server on port {port}.")
+		return True, None
+	try:
+		server_process = subprocess.Popen(['pandoc', 'server', f'--port={port}'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+	except OSError as e:
+		inform(f"Couldn't start pandoc server: {e}", severity="warning")
+		return False, None
+	deadline = time.monotonic() + pandoc_server_startup_timeout
+	while time.monotonic() < deadline:
+		if server_process.poll() is not None:
+			break
+		if pandoc_server_ready(port):
+			inform(f"Started pandoc server on port {port}.")
+			return True, server_process
+		time.sleep(0.1)
+	inform(f"pandoc server didn't become available on port {port}.", severity="warning")
+	stop_pandoc_server(server_process)
+	return False, None
+
+def stop_pandoc_server(server_process):
+	import subprocess
+	if server_process and server_process.poll() is None:
+		server_process.terminate()
+		try:
+			server_process.wait(timeout=5)
+		except subprocess.TimeoutExpired:
+			server_process.kill()
+
+def ensure_pandoc_server(port):
+	# Find or start pandoc server the first time a build stage needs it. Returns its port, or None if it's unavailable.
+	global pandoc_server_checked, pandoc_server_available, pandoc_server_process
+	with pandoc_server_lock:
+		if not pandoc_server_checked:
+			pandoc_server_checked = True
+			pandoc_server_available, pandoc_server_process = start_pandoc_server(port)
+			if not pandoc_server_available:
+				inform("Falling back to pandoc executable.", severity="warning")
+	return port if pandoc_server_available else None
+
+def pandoc_server_request(job, port, text, metadata):
+	# Render a format job via pandoc server, writing its output file. Raises on any failure, so the caller can fall back.
+	import base64
+	import urllib.request
+	options = {}
+	files = {}
+	for defaults_path in job["defaults"]:
+		for key, value in read_pandoc_defaults(defaults_path).items():
+			if key in pandoc_server_ignored_keys:
+				continue
+			if isinstance(value, list) and isinstance(options.get(key), list):
+				options[key] = options[key] + value
+			else:
+				options[key] = value
+	options["css"] = options.get("css", []) + job["css"]
+	# pandoc server can't read files itself, so send the template inline, and any local resources alongside.
+	if "template" in options:
+		with open(options["template"], 'r') as template_file:
+			options["template"] = template_file.read()
+	resource_paths = list(options["css"])
+	if job["format"] == "epub" and "cover-image" in metadata:
+		options["epub-cover-image"] = metadata["cover-image"]
+		resource_paths.append(metadata["cover-image"])
+	resource_paths += re.findall(r"!\[[^\]]*\]\(<?([^)\s>]+)", text)
+	for resource_path in resource_paths:
+		if os.path.isfile(resource_path):
+			with open(resource_path, 'rb') as resource_file:
+				files[resource_path] = base64.b64encode(resource_file.read()).decode("ascii")
+	options["files"] = files
+	options["metadata"] = metadata
+	options["text"] = text
+	
+	request = urllib.request.Request(pandoc_server_url(port), data=json.dumps(options).encode("utf-8"), headers={"Content-Type": "application/json", "Accept": "application/json"})
+	with urllib.request.urlopen(request, timeout=pandoc_server_request_timeout) as response:
+		result = json.load(response)
+	if not isinstance(result, dict) or "output" not in result:
+		raise ValueError(f"unexpected response from pandoc server: {str(result)[:200]}")
+	for message in result.get("messages", []):
+		if message.get("verbosity") in ["WARNING", "ERROR"]:
+			inform(f"pandoc ({job['format']}): {message.get('message', message)}", severity="warning")
+	output = base64.b64decode(result["output"]) if result.get("base64") else result["output"].encode("utf-8")
+	with open(job["filename"], 'wb') as output_file:
+		output_file.write(output)
+
+class FormatJobFailed(Exception):
+	pass
+
+class FormatJobKilled(Exception):
+	pass
+
+def host_available_memory():
+	# Returns the memory (MB) currently available for new processes without swapping, or None if unknown.
+	try:
+		with open("/proc/meminfo", 'r') as meminfo_file:
+			for line in meminfo_file:
+				if line.startswith("MemAvailable:"):
+					return int(line.split()[1]) // 1024
+	except (IOError, ValueError, IndexError):
+		pass
+	return None
+
+def host_total_memory():
+	# Returns the host's physical memory (MB), or None if unknown.
+	try:
+		return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // (1024 * 1024)
+	except (ValueError, OSError, AttributeError):
+		return None
+
+def estimate_job_memory(job, text):
+	base, per_mb = format_memory_estimates.get(job["format"], format_memory_estimates["html"])
+	return int(base + per_mb * len(text.encode("utf-8")) / (1024 * 1024))
+
+def admit_job(job, estimate):
+	# Wait until a format job's estimated memory fits within the memory budget (and the host's available memory), then reserve it.
+	# A job is always admitted when nothing else is running, so an over-budget job can still build, alone.
+	# Returns the memory (MB) the job may actually use: the budget, less what other running jobs have reserved (but
+	# never less than its estimate), or None if there's no budget. Estimates are rough, so they only decide admission.
+	global memory_reserved
+	if memory_budget <= 0:
+		return None
+	with memory_condition:
+		waiting = False
+		while memory_reserved > 0:
+			available = host_available_memory()
+			if memory_reserved + estimate <= memory_budget and (available is None or estimate <= available):
+				break
+			if not waiting:
+				inform(f"Waiting for memory to build {job['format']} format (needs about {estimate:,} MB; {memory_reserved:,} of {memory_budget:,} MB in use).")
+				waiting = True
+			# Recheck periodically too, since other processes' memory use changes.
+			memory_condition.wait(timeout=1)
+		if estimate > memory_budget:
+			inform(f"Building {job['format']} format may need about {estimate:,} MB, more than the memory budget of {memory_budget:,} MB. Building it alone.", severity="warning")
+		others_reserved = memory_reserved
+		memory_reserved += estimate
+		return max(estimate, memory_budget - others_reserved)
+
+def release_job(estimate):
+	global memory_reserved
+	if memory_budget <= 0:
+		return
+	with memory_condition:
+		memory_reserved -= estimate
+		memory_condition.notify_all()
+
+def limit_child_memory(command, limit_mb):
+	# Returns command wrapped so it (and any PDF engine it runs) can use at most limit_mb of memory, where limits are supported.
+	# The limit is set by a shell before running the command, since subprocess's preexec_fn isn't safe to use from threads.
+	# RLIMIT_DATA (ulimit -d) is used rather than RLIMIT_AS, because pandoc's Haskell runtime reserves a huge (but unused) address space.
+	if os.name != "posix" or not os.path.exists("/bin/sh"):
+		return command
+	return ["/bin/sh", "-c", f'ulimit -d {limit_mb * 1024} 2>/dev/null; exec "$@"', command[0]] + command
+
+def run_format_job(job, server_port=None, text=None, metadata=None, memory_limit=None):
+	# Build one output format, via pandoc server if available, falling back to the pandoc executable.
+	# 	memory_limit: if given, maximum memory (MB) of each pandoc (or PDF engine) process.
+	# Raises FormatJobKilled if pandoc seems to have run out of memory, or FormatJobFailed if it failed otherwise.
+	inform(f"Building {job['format']} format with pandoc...")
+	remove_format_output(job)
+	built_via = ""
+	if server_port and not job["server_unsupported"]:
+		try:
+			pandoc_server_request(job, server_port, text, metadata)
+			built_via = " (via pandoc server)"
+		except (OSError, ValueError) as e:
+			inform(f"pandoc server couldn't build {job['format']} format ({e}). Falling back to pandoc executable.", severity="warning")
+	if not built_via:
+		if show_pandoc_commands:
+			inform(f"Using pandoc command:\n{' '.join(job['command'])}")
+		import subprocess
+		# Capture pandoc's error output to look for signs of running out of memory, passing it on as usual.
+		p = subprocess.run(limit_child_memory(job["command"], memory_limit) if memory_limit else job["command"], stderr=subprocess.PIPE)
+		error_output = p.stderr.decode("utf-8", errors="replace")
+		sys.stderr.write(error_output)
+		if p.returncode != 0:
+			# Don't leave partial output behind.
+			remove_format_output(job)
+		# Killed by a signal (e.g. by the kernel's out-of-memory killer), pandoc's runtime ran out of heap, or the PDF engine ran out (e.g. WeasyPrint's MemoryError, which makes pandoc exit 43).
+		if p.returncode < 0 or p.returncode == 251 or (p.returncode != 0 and out_of_memory_regex.search(error_output)):
+			raise FormatJobKilled(f"pandoc exited with status {p.returncode}")
+		elif p.returncode != 0:
+			raise FormatJobFailed(f"pandoc exited with status {p.returncode}")
+	if not os.path.isfile(job["filename"]):
+		raise FormatJobFailed(f"pandoc didn't create {job['filename']}")
+	
+	if job["format"] == "html-chunked":
+		num_pages = chunk_html(job["filename"], job["folder"])
+		os.remove(job["filename"])
+		inform(f"Built {job['format']} format: {job['folder']}/ ({num_pages} pages){built_via}")
+	else:
+		inform(f"Built {job['format']} format: {job['filename']}{built_via}")
+
+def remove_format_output(job):
+	# Remove a format's output from any previous build, so a failed build can't leave it looking current.
+	output_paths = [job["filename"]]
+	if job["format"] == "html-chunked":
+		output_paths += glob.glob(os.path.join(job["folder"], "*.html"))
+	for output_path in output_paths:
+		if os.path.isfile(output_path):
+			os.remove(output_path)
+
+def chunk_html(source_path, output_folder):
+	# Split a standalone HTML book into one page per top-level section, plus an index page linking to them all.
+	# Returns the number of pages written.
+	import html
+	with open(source_path, 'r') as source_file:
+		source = source_file.read()
+	body_match = re.search(r"(?is)(<body[^>]*>)(.*)(</body>)", source)
+	if not body_match:
+		raise ValueError(f"no body found in {source_path}")
+	
+	# Pages live in a subfolder, so adjust relative resource paths (stylesheets, images, etc).
+	def relocate(attr_match):
+		url = attr_match.group(2)
+		if re.match(r"(?i)^(#|/|[a-z][a-z0-9+.-]*:)", url):
+			return attr_match.group(0)
+		return f'{attr_match.group(1)}="../{url}"'
+	head = re.sub(r'\b(href|src)="([^"]*)"', relocate, source[:body_match.start(2)])
+	tail = source[body_match.end(2):]
+	body = re.sub(r'\b(href|src)="([^"]*)"', relocate, body_match.group(2))
+	title_match = re.search(r"(?is)<title>(.*?)</title>", head)
+	book_title = title_match.group(1).strip() if title_match else ""
+	
+	# Find the top-level sections, which become pages. Anything between them stays with the preceding page.
+	chunks = []
+	depth = 0
+	for tag_match in re.finditer(r"(?i)<(/?)section\b[^>]*>", body):
+		if tag_match.group(1):
+			depth = max(depth - 1, 0)
+		else:
+			if depth == 0:
+				# Anything before the first section joins the first page.
+				chunk_start = tag_match.start() if len(chunks) > 0 else 0
+				if len(chunks) > 0:
+					chunks[-1][1] = chunk_start
+				chunks.append([chunk_start, None])
+			depth += 1
+	if len(chunks) == 0:
+		chunks = [[0, None]]
+	chunks[-1][1] = len(body)
+	
+	pages = []
+	for chunk_num, (start, end) in enumerate(chunks, start=1):
+		content = body[start:end]
+		section_match = re.search(r'(?i)<section\b[^>]*\bid="([^"]+)"', content)
+		page_id = section_match.group(1) if section_match else f"section-{chunk_num}"
+		section_tag_match = re.search(r"(?i)<section\b[^>]*>", content)
+		unlisted = bool(section_tag_match and re.search(r'(?i)class="[^"]*\b(no-?toc|unlisted)\b', section_tag_match.group(0)))
+		heading_match = re.search(r"(?is)<h[1-6][^>]*>(.*?)</h[1-6]>", content)
+		page_title = html.unescape(re.sub(r"<[^>]+>", "", heading_match.group(1))).strip() if heading_match else ""
+		pages.append({"filename": f"{chunk_num:03d}-{page_id}.html", "title": page_title or f"Section {chunk_num}", "content": content, "ids": re.findall(r'\bid="([^"]+)"', content), "unlisted": unlisted})
+	
+	# Point same-document links at whichever page now holds their target.
+	id_pages = {}
+	for page in pages:
+		for element_id in page["ids"]:
+			id_pages.setdefault(element_id, page["filename"])
+	def retarget(link_match, this_page):
+		target_page = id_pages.get(link_match.group(1))
+		if not target_page or target_page == this_page:
+			return link_match.group(0)
+		return f'href="{target_page}#{link_match.group(1)}"'
+	
+	os.makedirs(output_folder, exist_ok=True)
+	for old_page in glob.glob(os.path.join(output_folder, "*.html")):
+		os.remove(old_page)
+	for page_num, page in enumerate(pages):
+		prev_page = pages[page_num - 1] if page_num > 0 else None
+		next_page = pages[page_num + 1] if page_num < len(pages) - 1 else None
+		nav_links = [f'<a href="{prev_page["filename"]}" rel="prev">Previous</a>' if prev_page else "", f'<a href="{chunked_index_filename}">Contents</a>', f'<a href="{next_page["filename"]}" rel="next">Next</a>' if next_page else ""]
+		nav = f'<nav class="chunk-nav">{" ".join(link for link in nav_links if link)}</nav>'
+		page_head = re.sub(r"(?is)<title>.*?</title>", f"<title>{html.escape(page['title'])} – {book_title}</title>", head)
+		if next_page:
+			# Let the browser fetch the next page while the reader is busy with this one.
+			page_head = page_head.replace("</head>", f'<link rel="prefetch" href="{next_page["filename"]}" />\n</head>', 1)
+		content = re.sub(r'href="#([^"]+)"', lambda m: retarget(m, page["filename"]), page["content"])
+		with open(os.path.join(output_folder, page["filename"]), 'w') as page_file:
+			page_file.write(f"{page_head}\n{nav}\n{content}\n{nav}\n{tail}")
+	
+	index_items = "\n".join(f'<li><a href="{page["filename"]}">{html.escape(page["title"])}</a></li>' for page in pages if not page["unlisted"])
+	with open(os.path.join(output_folder, chunked_index_filename), 'w') as index_file:
+		index_file.write(f'{head}\n<nav class="chunk-index" role="doc-toc">\n<ol>\n{index_items}\n</ol>\n</nav>\n{tail}')
+	return len(pages) + 1
+
+def strip_unused_css(css_text, used_classes, used_ids):
+	# Remove style rules whose selectors all refer to classes or IDs which don't appear in the document.
+	# At-rules (@media, @font-face, @page, etc) and anything we can't safely analyse are kept as-is.
+	css_text = re.sub(r"/\*.*?\*/", "", css_text, flags=re.DOTALL)
+	kept = []
+	pos = 0
+	while pos < len(css_text):
+		brace_pos = css_text.find("{", pos)
+		if brace_pos == -1:
+			kept.append(css_text[pos:])
+			break
+		prelude = css_text[pos:brace_pos]
+		# Find the matching closing brace, allowing for nested blocks.
+		depth = 0
+		end_pos = brace_pos
+		while end_pos < len(css_text):
+			if css_text[end_pos] == "{":
+				depth += 1
+			elif css_text[end_pos] == "}":
+				depth -= 1
+				if depth == 0:
+					break
+			end_pos += 1
+		rule = css_text[pos:end_pos + 1]
+		pos = end_pos + 1
+		if prelude.strip().startswith("@") or ":not(" in prelude:
+			kept.append(rule)
+			continue
+		for selector in prelude.split(","):
+			# Ignore attribute selectors and strings, which may contain periods or hashes.
+			selector = re.sub(r"\[[^\]]*\]|\"[^\"]*\"|'[^']*'", "", selector)
+			classes = re.findall(r"\.(-?[_a-zA-Z][\w-]*)", selector)
+			ids = re.findall(r"#(-?[_a-zA-Z][\w-]*)", selector)
+			if all(c in used_classes for c in classes) and all(i in used_ids for i in ids):
+				kept.append(rule)
+				break
+	return "".join(kept)
+
+def subset_font(font_data, characters):
+	# Subset a font to the given characters, keeping its original flavour (e.g. woff2). Requires fontTools.
+	import io
+	from fontTools import subset
+	from fontTools.ttLib import TTFont
+	font = TTFont(io.BytesIO(font_data))
+	options = subset.Options()
+	options.layout_features = ["*"]
+	options.name_IDs = ["*"]
+	options.notdef_outline = True
+	options.flavor = font.flavor
+	subsetter = subset.Subsetter(options=options)
+	subsetter.populate(text="".join(sorted(characters)))
+	subsetter.subset(font)
+	output = io.BytesIO()
+	font.save(output)
+	return output.getvalue()
+
+def optimise_epub(epub_path):
+	# Subset embedded fonts, strip unused CSS rules, and recompress the container. Returns (size before, size after).
+	import html
+	import zipfile
+	size_before = os.path.getsize(epub_path)
+	with zipfile.ZipFile(epub_path, 'r') as epub_zip:
+		entries = [(info, epub_zip.read(info.filename)) for info in epub_zip.infolist()]
+	
+	# Find the characters, classes, and IDs actually used by the book's content.
+	used_characters = set()
+	used_classes = set()
+	used_ids = set()
+	for info, data in entries:
+		if info.filename.endswith((".xhtml", ".html", ".htm")):
+			content = data.decode("utf-8", errors="replace")
+			for class_attr in re.findall(r"\bclass=[\"']([^\"']*)[\"']", content):
+				used_classes.update(class_attr.split())
+			used_ids.update(re.findall(r"\bid=[\"']([^\"']*)[\"']", content))
+			body_match = re.search(r"(?is)<body.*?>(.*)</body>", content)
+			text = html.unescape(re.sub(r"<[^>]+>", "", body_match.group(1) if body_match else content))
+			used_characters.update(text)
+		elif info.filename.endswith(".css"):
+			# Generated content (e.g. ornaments) also needs its glyphs.
+			for css_string in re.findall(r"\"([^\"]*)\"|'([^']*)'", data.decode("utf-8", errors="replace")):
+				used_characters.update("".join(css_string))
+	# Allow for text-transform and small-caps.
+	used_characters.update("".join(used_characters).upper() + "".join(used_characters).lower())
+	used_characters.discard("\n")
+	
+	optimised_entries = []
+	can_subset_fonts = True
+	for info, data in entries:
+		if info.filename.endswith(".css"):
+			try:
+				data = strip_unused_css(data.decode("utf-8"), used_classes, used_ids).encode("utf-8")
+			except UnicodeDecodeError as e:
+				inform(f"Couldn't read stylesheet {info.filename} as UTF-8; keeping it whole: {e}", severity="warning")
+		elif info.filename.lower().endswith(font_file_extensions) and can_subset_fonts:
+			try:
+				data = subset_font(data, used_characters)
+			except ImportError as e:
+				inform(f"Couldn't find fontTools module, so not subsetting fonts: {e}", severity="warning")
+				can_subset_fonts = False
+			except Exception as e:
+				inform(f"Couldn't subset font {info.filename}; keeping it whole: {e}", severity="warning")
+		optimised_entries.append((info, data))
+	
+	# The mimetype entry must come first, and be stored uncompressed.
+	optimised_entries.sort(key=lambda entry: entry[0].filename != "mimetype")
+	temp_path = f"{epub_path}.{os.getpid()}.tmp"
+	try:
+		with zipfile.ZipFile(temp_path, 'w') as epub_zip:
+			for info, data in optimised_entries:
+				if info.filename == "mimetype":
+					epub_zip.writestr(info.filename, data, compress_type=zipfile.ZIP_STORED)
+				else:
+					epub_zip.writestr(info.filename, data, compress_type=zipfile.ZIP_DEFLATED, compresslevel=9)
+		os.replace(temp_path, epub_path)
+	finally:
+		# Leave the original epub in place if anything went wrong.
+		if os.path.exists(temp_path):
+			os.remove(temp_path)
+	return size_before, os.path.getsize(epub_path)
+
+def describe_size_change(size_before, size_after):
+	change = ((size_after - size_before) / size_before * 100) if size_before > 0 else 0
+	return f"{size_before:,} bytes to {size_after:,} bytes ({change:+.1f}%)"
+
+def optimise_format_output(job):
+	# Reduce the size of a built format where we can, reporting the result.
+	# Optimisation is a bonus, so any problem with it leaves the format as pandoc built it, with a warning.
+	if not os.path.isfile(job["filename"]):
+		return
+	if job["format"] == "epub":
+		try:
+			size_before, size_after = optimise_epub(job["filename"])
+			inform(f"Optimised {job['filename']}: {describe_size_change(size_before, size_after)}", force=True)
+		except Exception as e:
+			inform(f"Couldn't optimise {job['filename']}: {e}", severity="warning")
+	elif job["format"].startswith("pdf"):
+		# WeasyPrint already subsets fonts and compresses PDFs.
+		inform(f"Size of {job['filename']}: {os.path.getsize(job['filename']):,} bytes", force=True)
+
+class MGArgumentParser(argparse.ArgumentParser):
+	def convert_arg_line_to_args(self, arg_line):
+		# Ignore whitespace or #-commented lines
+		if (re.match(r"^[\s]*#", arg_line) or 
+				re.match(r"^[\s]*$", arg_line)):
+			return []
+		# Split on first whitespace to allow full arg+vals per line.
+		#return re.split(r"[ =]", arg_line, maxsplit=1)
+		return re.split(r"\s+", arg_line, maxsplit=1)
+
+# --- Main script begins ---
+
+def main():
+	# Run a build, as configured by the command-line arguments (and any args file).
+	# These module-level settings are used throughout the functions above.
+	global verbose_mode, show_pandoc_commands, use_cache, cache_folder_path, rule_time_budget, rule_budget_action, memory_budget
+	
+	# Check for an args file.
+	found_args_file = False
+	file_args_prefix = '@'
+	if os.path.isfile(default_args_filename):
+		found_args_file = True
+		sys.argv.insert(1, f"{file_args_prefix}{default_args_filename}")
+
+	parser=MGArgumentParser(allow_abbrev=False, fromfile_prefix_chars=file_args_prefix)
+	parser.add_argument('--input-folder', '-i', help="Input folder of Markdown files", type= str, required=True)
+	parser.add_argument('--exclude', '-e', help=f"[optional] Regular expressions (one or more, space-separated) matching filenames of Markdown documents to exclude from the built books", action="store", nargs='+', default= None)
+	parser.add_argument('--json-metadata-file', '-j', help="JSON file with metadata", type= str, default=default_metadata_filename)
+	parser.add_argument('--exclusions-file', '-E', help="File of exclusion rules", type= str, default=default_exclusions_filename)
+	parser.add_argument('--transformations-file', '-t', help="File of transformations to perform", type= str, default=default_transformations_filename)
+	parser.add_argument('--replacement-mode', '-m', choices=valid_placeholder_modes + ["none"], help=f"[optional] Replacement system to use: {', '.join(valid_placeholder_modes)} (default is {valid_placeholder_modes[0]})", type= str, default= valid_placeholder_modes[0])
+	parser.add_argument('--output-basename', '-o', help=f"[optional] Output filename without extension (default is automatic based on metadata)", type= str, default= None)
+	parser.add_argument('--verbose', '-v', help="[optional] Enable verbose logging", action="store_true", default=False)
+	parser.add_argument('--check-tks', help="[optional] Check for TKs in Markdown files (default: enabled), or disable with --no-check-tks", action=argparse.BooleanOptionalAction, default=True)
+	parser.add_argument('--stop-on-tks', '-k', help="[optional] Treat TKs as errors and stop", action="store_true", default=False)
+	parser.add_argument('--process-figuremark', help=f"[optional] Rewrite any FigureMark-formatted blocks as HTML figures. See documentation.", action=argparse.BooleanOptionalAction, default=False)
+	parser.add_argument('--process-textindex', help=f"[optional] Processes TextIndex index marks to create a document index. See documentation.", action=argparse.BooleanOptionalAction, default=False)
+	parser.add_argument('--process-toc', help=f"[optional] Replace any table-of-contents placeholders with a suitable ToC. See documentation.", action=argparse.BooleanOptionalAction, default=True)
+	parser.add_argument('--run-transformations', help=f"[optional] Perform any transformations found in default or specified transformations file (default: enabled), or disable with --no-run-transformations", action=argparse.BooleanOptionalAction, default=True)
+	parser.add_argument('--run-exclusions', help=f"[optional] Process any exclusions from --exclude arguments, or in the default or specified exclusions file (default: enabled), or disable with --no-run-exclusions", action=argparse.BooleanOptionalAction, default=True)
+	parser.add_argument('--formats', '-f', help=f"[optional] Output formats to create (as many as required), from: {', '.join(valid_output_formats)}, or all (default 'epub pdf')", action='store', nargs='+', choices=valid_output_formats + ["all"], default=None)
+	parser.add_argument('--draft', help=f"[optional] Build a quick preview: a single html (default) or pdf format, with low-resolution images, and without TextIndex or output optimisation", action="store_true", default=False)
+	parser.add_argument('--draft-range', help=f"[optional] With --draft, only build from the first Markdown file whose path matches the FIRST regular expression, to the first after it matching LAST (or just that one file)", action="store", nargs='+', metavar=("FIRST", "LAST"), default=None)
+	parser.add_argument('--retain-collated-master', '-c', help="[optional] Keeps the collated master Markdown file after generating books, instead of deleting it.", action="store_true", default=False)
+	parser.add_argument('--pandoc-verbose', '-V', help="[optional] Tell pandoc to enable its own verbose logging", action="store_true", default=False)
+	parser.add_argument('--show-pandoc-commands', '-p', help="[optional] Display the actual pandoc commands and arguments when invoking them for each format", action="store_true", default=False)
+	parser.add_argument('--rule-time-budget', help=f"[optional] Maximum time in seconds that any single exclusion or transformation rule may spend matching over the whole build (default 0, meaning unlimited)", type=float, default=0)
+	parser.add_argument('--rule-budget-action', choices=valid_rule_budget_actions, help=f"[optional] What to do when a rule exceeds its time budget: {', '.join(valid_rule_budget_actions)} (default is {valid_rule_budget_actions[0]})", type=str, default=valid_rule_budget_actions[0])
+	parser.add_argument('--report-rule-costs', help=f"[optional] Report the time spent, matches found, and bytes scanned by each exclusion and transformation rule at the end of the build (always reported in verbose mode)", action="store_true", default=False)
+	parser.add_argument('--use-cache', help=f"[optional] Skip build stages whose inputs haven't changed, reusing their cached output (default: enabled), or disable with --no-use-cache", action=argparse.BooleanOptionalAction, default=True)
+	parser.add_argument('--cache-folder', help=f"[optional] Folder in which to keep cached processing output, shared between books (default is {default_cache_folder_path})", type=str, default=default_cache_folder_path)
+	parser.add_argument('--cache-max-size', help=f"[optional] Maximum size in MB of the cache folder, beyond which the least recently used entries are removed (default {default_cache_max_size}, or 0 for no limit)", type=int, default=default_cache_max_size)
+	parser.add_argument('--report-cache-stats', help=f"[optional] Report how much cached output was reused, for each kind of processing, at the end of the build (always reported in verbose mode)", action="store_true", default=False)
+	parser.add_argument('--read-workers', help=f"[optional] Number of Markdown files to read concurrently, which helps on network or synced filesystems (default {default_read_workers})", type=int, default=default_read_workers)
+	parser.add_argument('--optimise-output', help="[optional] Reduce the size of built books: subset embedded fonts, strip unused CSS, and recompress epub files. Font subsetting requires fontTools for python3.", action=argparse.BooleanOptionalAction, default=False)
+	parser.add_argument('--pandoc-server', help="[optional] Render formats concurrently via a long-running pandoc server, starting one if needed, and falling back to the pandoc executable where necessary", action=argparse.BooleanOptionalAction, default=False)
+	parser.add_argument('--pandoc-server-port', help=f"[optional] Port for pandoc server (default {default_pandoc_server_port})", type=int, default=default_pandoc_server_port)
+	parser.add_argument('--keep-pandoc-server', help="[optional] Leave a pandoc server started by this build running afterwards, for reuse by later builds", action="store_true", default=False)
+	parser.add_argument('--jobs', help=f"[optional] Maximum number of independent build stages (such as formats) to run at once (default is the number of CPU cores)", type=int, default=None)
+	parser.add_argument('--memory-budget', help=f"[optional] Total memory in MB that formats being built at the same time may use, with each pandoc process limited to its share (default is {int(default_memory_budget_fraction * 100)}%% of the memory available when the build starts, or 0 for no limit)", type=int, default=None)
+	parser.add_argument('--explain', help="[optional] Show why each build stage ran, or was skipped because its inputs hadn't changed", action="store_true", default=False)
+	parser.add_argument('--lang', '-l', help="[optional] Define the language for the book being generated (this will overwrite the lang option in the metadata file)", type=str, default="")
+	args=parser.parse_known_args()
+
+	# Obtain configuration parameters
+	this_script_path = os.path.abspath(os.path.expanduser(sys.argv[0]))
+	folder_path = args[0].input_folder
+	exclusions = args[0].exclude
+	json_file_path = args[0].json_metadata_file
+	exclusions_path = args[0].exclusions_file
+	transformations_path = args[0].transformations_file
+	placeholder_mode = args[0].replacement_mode
+	output_basename = args[0].output_basename
+	verbose_mode = (args[0].verbose == True)
+	check_tks = (args[0].check_tks == True)
+	stop_on_tks = (args[0].stop_on_tks == True)
+	process_figuremark = (args[0].process_figuremark == True)
+	process_textindex = (args[0].process_textindex == True)
+	should_process_toc = (args[0].process_toc == True)
+	run_transformations = (args[0].run_transformations == True)
+	run_exclusions = (args[0].run_exclusions == True)
+	output_formats = args[0].formats
+	draft_mode = (args[0].draft == True)
+	draft_range = args[0].draft_range
+	lang = args[0].lang
+	read_workers = max(args[0].read_workers, 1)
+	optimise_output = (args[0].optimise_output == True)
+	rule_time_budget = max(args[0].rule_time_budget, 0)
+	rule_budget_action = args[0].rule_budget_action
+	report_costs = (args[0].report_rule_costs == True)
+	use_cache = (args[0].use_cache == True)
+	cache_folder_path = os.path.abspath(os.path.expanduser(args[0].cache_folder))
+	cache_max_size = max(args[0].cache_max_size, 0)
+	report_cache = (args[0].report_cache_stats == True)
+	if draft_mode:
+		# Build only the first suitable requested format, defaulting to html.
+		draft_formats = [f for f in (output_formats or []) if f in draft_output_formats]
+		output_formats = draft_formats[:1] if len(draft_formats) > 0 else ["html"]
+		inform(f"Draft mode enabled. Building {output_formats[0]} format only, without TextIndex or output optimisation.", force=True)
+		process_textindex = False
+		optimise_output = False
+	elif output_formats is None:
+		output_formats = ["epub", "pdf"]
+	if draft_range and (not draft_mode or len(draft_range) > 2):
+		inform("--draft-range requires --draft, and accepts one or two patterns.", severity="error")
+		sys.exit(1)
+	if isinstance(output_formats, list):
+		# Uniquify
+		output_formats = list(dict.fromkeys(output_formats))
+	else:
+		output_formats = [output_formats]
+	pandoc_verbose = (args[0].pandoc_verbose == True)
+	show_pandoc_commands = (args[0].show_pandoc_commands == True)
+	use_pandoc_server = (args[0].pandoc_server == True)
+	pandoc_server_port = args[0].pandoc_server_port
+	keep_pandoc_server = (args[0].keep_pandoc_server == True)
+	retain_collated_master = (args[0].retain_collated_master == True)
+	build_jobs = max(args[0].jobs or os.cpu_count() or 1, 1)
+	explain_stages = (args[0].explain == True)
+	memory_budget = args[0].memory_budget
+	if memory_budget is None:
+		host_memory = host_available_memory() or host_total_memory()
+		memory_budget = int(host_memory * default_memory_budget_fraction) if host_memory else 0
+	memory_budget = max(memory_budget, 0)
+	if memory_budget > 0:
+		inform(f"Memory budget for building formats: {memory_budget:,} MB.")
+	extra_args = None
+	if len(args[1]) > 0:
+		extra_args = ' '.join(args[1])
+
+	if found_args_file:
+		inform(f"Found args file {default_args_filename}. Processing.")
+
+	# Check if folder_path exists and is a folder.
+	full_folder_path = os.path.abspath(os.path.expanduser(folder_path))
+	inform(f"Path to Markdown folder: {full_folder_path}")
+	if not os.path.isdir(full_folder_path):
+		inform("Path to Markdown folder isn't a folder.", severity="error")
+		sys.exit(1)
+
+	# Check if json_file_path exists and is a file.
+	full_metadata_path = os.path.abspath(os.path.expanduser(json_file_path))
+	inform(f"Path to JSON metadata file: {full_metadata_path}")
+	if not os.path.isfile(full_metadata_path):
+		inform("Path to JSON metadata file isn't a file.", severity="error")
+		sys.exit(1)
+
+	# Prepare extra metadata.
+	now = datetime.datetime.now()
+	meta_date = now.strftime("%Y-%m-%d")
+	meta_date_year = now.strftime("%Y")
+
+	# Read the JSON metadata file.
+	json_contents = None
+	try:
+		json_file = open(full_metadata_path, 'r')
+		json_contents = json.load(json_file)
+		json_file.close()
+	except IOError as e:
+			inform(f"Couldn't read JSON metadata file: {e}", severity="error")
+			sys.exit(1)
+
+	# Add dynamically-generated extra metadata.
+	json_contents['date'] = meta_date
+	json_contents['date-year'] = meta_date_year
+
+	# Add any metadata specified as arguments in extra_args.
+	if args[1] and len(args[1]) > 0:
+		metadata_arg_expr = r"(?:--metadata[ =]|-M )([^ =:]+)[=:](['\"].+?['\"]|\S+)"
+		# Find all matches in extra_args, then trim any single or double quotes around values.
+		for this_arg in re.finditer(metadata_arg_expr, extra_args):
+			meta_key, meta_val = this_arg.group(1), this_arg.group(2)
+			meta_val = meta_val[1:-1] if len(meta_val) > 2 and meta_val[0] in ['"', "'"] else meta_val
+			json_contents[meta_key] = meta_val
+
+	# Validate placeholder mode.
+	if placeholder_mode not in valid_placeholder_modes:
+		inform(f"Invalid placeholder mode ({placeholder_mode}); should be {', '.join(valid_modes)} or none.", severity="error")
+		sys.exit(1)
+
+	# Substitute 'title' and 'subtitle' with the correct translation (if any).
+	if lang and lang != "":
+		json_contents['lang'] = lang
+		title_key = f"title_{lang}"
+		subtitle_key = f"subtitle_{lang}"
+		cover_key= f"cover-image_{lang}"
+		if title_key in json_contents:
+			json_contents['title'] = json_contents[title_key]
+		if subtitle_key in json_contents:
+			json_contents['subtitle'] = json_contents[subtitle_key]
+		if cover_key in json_contents:
+			json_contents['cover-image'] = json_contents[cover_key]
+
+	# Obtain all Markdown files, sorted sensibly.
+	files = sorted_alphanumeric([p for p in glob.glob(f"{full_folder_path}/**/*", recursive=True) if os.path.isfile(p) and p.endswith((".md", ".markdown", ".mdown"))])
+
+	# Normalise exclusions and try to load additional patterns from a file.
+	tsv_delimiter = "\t"
+	exclusion_mode_key, exclusion_scope_key, path_key, search_key, replace_key, comment_key, negation_key = "mode", "scope", "path", "search", "replace", "comment", "negated"
+	source_key = "source"
+	mode_exclude, mode_e, mode_include, mode_i = "exclude", "e", "include", "i"
+	valid_exclusion_modes = [mode_exclude, mode_e, mode_include, mode_i]
+	scope_filename, scope_f, scope_filepath, scope_p, scope_fullpath, scope_u, scope_contents, scope_c = "filename", "f", "filepath", "p", "fullpath", "u", "contents", "c"
+	valid_exclusion_scopes = [scope_filename, scope_f, scope_filepath, scope_p, scope_fullpath, scope_u, scope_contents, scope_c]
+	path_any = "*"
+
+	exclusions_map = []
+	if exclusions and run_exclusions:
+		for excl_num, excl in enumerate(exclusions, start=1):
+			exclusions_map.append({exclusion_mode_key: mode_exclude, exclusion_scope_key: scope_filename, path_key: path_any, search_key: excl, source_key: f"--exclude pattern {excl_num}"})
+
+	full_exclusions_path = os.path.abspath(os.path.expanduser(exclusions_path))
+	inform(f"Checking for exclusions file: {full_exclusions_path}")
+	if not os.path.isfile(full_exclusions_path):
+		inform(f"Exclusions file not found. Continuing.")
+	elif run_exclusions:
+		try:
+			# Read the exclusions file.
+			exclusions_file = open(full_exclusions_path, 'r')
+			inform(f"Exclusions file found. Processing.")
+			for line_num, line in enumerate(exclusions_file, start=1):
+				line = re.sub(r"\t+", "\t", line) # Collapse tab-runs
+				components = line.strip('\n').split(tsv_delimiter)
+				if len(components) > 3:
+					exclusion = {exclusion_mode_key: components[0], exclusion_scope_key: components[1], path_key: components[2], search_key: components[3]}
+					if len(components) > 4:
+						exclusion[comment_key] = tsv_delimiter.join(components[4:]).rstrip()
+					if exclusion[exclusion_mode_key] in valid_exclusion_modes and exclusion[exclusion_scope_key] in valid_exclusion_scopes:
+						# Normalise modes and scopes.
+						if exclusion[exclusion_mode_key] == mode_e:
+							exclusion[exclusion_mode_key] = mode_exclude
+						elif exclusion[exclusion_mode_key] == mode_i:
+							exclusion[exclusion_mode_key] = mode_include
+						
+						if exclusion[exclusion_scope_key] == scope_f:
+							exclusion[exclusion_scope_key] = scope_filename
+						elif exclusion[exclusion_scope_key] == scope_p:
+							exclusion[exclusion_scope_key] = scope_filepath
+						elif exclusion[exclusion_scope_key] == scope_u:
+							exclusion[exclusion_scope_key] = scope_fullpath
+						elif exclusion[exclusion_scope_key] == scope_c:
+							exclusion[exclusion_scope_key] = scope_contents
+						
+						# Consider metadata-substitution flags, if present.
+						valid_rule = True
+						log_delim = "  "
+						orig_rule = log_delim.join(exclusion.values())
+						rule_rewritten = False
+						for this_key in [search_key, path_key, comment_key]:
+							should_rewrite = False
+							this_value = exclusion[this_key] if this_key in exclusion else None
+							
+							if this_key == comment_key and rule_rewritten and comment_key in exclusion:
+								# We already rewrote search and/or path, and we have a comment field. Rewrite it too.
+								should_rewrite = True
+								
+							elif this_value:
+								flag_match = pattern_has_flag(this_value, pattern_metadata_flag)
+								if flag_match:
+									should_rewrite = True
+									inform(f"- Metadata pattern flag (?{pattern_metadata_flag}) detected. Processing:")
+									# Remove the pattern_metadata_flag from this pattern.
+									this_value = pattern_strip_flag(this_value, pattern_metadata_flag)
+									rule_rewritten = True
+							
+							if should_rewrite and this_value:
+								# Process token replacement.
+								token_match = re.search(pattern_metadata_key_regex, this_value)
+								while token_match:
+									meta_key = token_match.group(1)
+									if meta_key in json_contents:
+										meta_val = json_contents[meta_key]
+										this_value = this_value[:token_match.start()] + meta_val + this_value[token_match.end():]
+									else:
+										inform(f"Requested key '{meta_key}' not found in metadata. Ignoring this exclusion.", severity="warning")
+										valid_rule = False
+										break
+									token_match = re.search(pattern_metadata_key_regex, this_value)
+								if valid_rule:
+									delim = "  "
+									exclusion[this_key] = this_value
+								else:
+									# Break from loop over exclusions keys
+									break
+						
+						if rule_rewritten:
+							inform(f"- Rewrote rule metadata pattern:\n  {orig_rule}\n  as:\n  {log_delim.join(exclusion.values())}.")
+						
+						# Consider negation flag.
+						for this_key in [search_key, path_key]:
+							this_value = exclusion[this_key]
+							flag_match = pattern_has_flag(this_value, pattern_negate_flag)
+							if flag_match:
+								inform(f"- Negation pattern flag (?{pattern_negate_flag}) detected in {this_key} pattern. Processing.")
+								if negation_key not in exclusion:
+									exclusion[negation_key] = []
+								exclusion[negation_key].append(this_key)
+								# Remove the pattern_negate_flag from this pattern.
+								this_value = pattern_strip_flag(this_value, pattern_negate_flag)
+								exclusion[this_key] = this_value
+						
+						if valid_rule:
+							exclusion[source_key] = f"{os.path.basename(full_exclusions_path)} line {line_num}"
+							exclusions_map.append(exclusion)
+						
+			exclusions_file.close()
+		except IOError as e:
+			inform(f"Couldn't read exclusions file: {e}", severity="warning")
+
+	# Load any requested transformations.
+	transformations = []
+	if run_transformations:
+		full_transformations_path = os.path.abspath(os.path.expanduser(transformations_path))
+		
+		inform(f"Checking for transformations file: {full_transformations_path}")
+		if not os.path.isfile(full_transformations_path):
+			inform(f"Transformations file not found. Continuing.")
+		else:
+			try:
+				# Read the transformations file.
+				transformations_file = open(full_transformations_path, 'r')
+				for line_num, line in enumerate(transformations_file, start=1):
+					line = re.sub(r"\t+", "\t", line) # Collapse tab-runs
+					components = line.strip('\n').split(tsv_delimiter)
+					if len(components) > 1:
+						transformation = {search_key: components[1], source_key: f"{os.path.basename(full_transformations_path)} line {line_num}"}
+						if components[0] != "":
+							transformation[comment_key] = components[0]
+						if len(components) > 2:
+							transformation[replace_key] = components[2]
+						else:
+							transformation[replace_key] = ""
+						transformations.append(transformation)
+				transformations_file.close()
+			except IOError as e:
+				inform(f"Couldn't read transformations file: {e}", severity="warning")
+			
+			if len(transformations) == 0:
+				inform("No transformations found in file. Continuing.")
+
+	# Save master file with timestamp, or without if we're retaining it.
+	if retain_collated_master:
+		master_filename = f"{master_basename}.md"
+	else:
+		timestamp = now.strftime("%Y%m%d-%H%M%S-%f")
+		master_filename = f"{master_basename}-{timestamp}.md"
+
+	# Determine output basename, if not already specified.
+	if not output_basename:
+		inform(f"No output basename supplied in arguments; checking metadata.")
+		basename_key = "basename"
+		title_key = "title"
+		subtitle_key = "subtitle"
+		if basename_key in json_contents and json_contents[basename_key] != "":
+			output_basename = json_contents[basename_key]
+			inform(f"Using basename specified in metadata: {output_basename}")
+		else:
+			# Slugify the 'title' entry as a filename, appending subtitle if present.
+			if title_key in json_contents and json_contents[title_key] != "":
+				title_val = json_contents[title_key]
+				if subtitle_key in json_contents and json_contents[subtitle_key] != "":
+					title_val = f"{title_val} - {json_contents[subtitle_key]}"
+				output_basename = string_to_slug(title_val)
+				inform(f"Converted metadata '{title_val}' to basename: {output_basename}")
+			else:
+				inform(f"Couldn't find '{basename_key}' or '{title_key}' in metadata.", severity="error")
+				sys.exit(1)
+	else:
+		inform(f"Requested output basename: {output_basename}")
+	if draft_mode:
+		output_basename = f"{output_basename}-draft"
+
+	if extra_args:
+		inform(f"Found extra arguments. Passing them to pandoc: {extra_args}")
+
+	# Invoke pandoc for each format, passing extra_args and warning for unrecognised formats.
+	inform(f"Output formats requested: {', '.join(output_formats)}")
+	all_formats = "all" in output_formats
+	yaml_shared_path = os.path.join(os.path.dirname(this_script_path), "options-shared.yaml")
+	# Final arg list will be: pre_args + (format-specific args, so settings/styles override properly) + post_args
+	pandoc_pre_args = ['pandoc', f'--defaults={yaml_shared_path}']
+	pandoc_post_args = [f'--metadata-file={full_metadata_path}', f'--metadata=date:"{meta_date}"', f'--metadata=date-year:"{meta_date_year}"', master_filename]
+	# Work around pandoc issue with not accepting css entries in metadata files.
+	extra_css = []
+	if "css" in json_contents:
+		extra_css = json_contents["css"]
+		if not isinstance(extra_css, list):
+			extra_css = [extra_css]
+		for css_arg in extra_css:
+			pandoc_post_args.append(f"--css={css_arg}")
+	if pandoc_verbose:
+		pandoc_post_args.append("--verbose")
+	if extra_args:
+		pandoc_post_args.append(extra_args)
+
+	# Assemble a build job for each format.
+	format_jobs = []
+	format_filenames = []
+	for this_format in output_formats:
+		if not this_format in valid_output_formats and this_format != "all":
+			inform(f"Output format '{this_format}' not presently supported. Skipping.", severity="warning")
+			continue
+		
+		yaml_epub_path = os.path.join(os.path.dirname(this_script_path), "options-epub.yaml")
+		yaml_pdf_path = os.path.join(os.path.dirname(this_script_path), "options-pdf.yaml")
+		css_pdf_6x9_path = os.path.join(os.path.dirname(this_script_path), "pdf-6x9.css")
+		this_format_jobs = []
+		if this_format == "epub" or all_formats:
+			this_format_jobs.append({"format": "epub", "filename": f"{output_basename}.epub", "defaults": [yaml_epub_path], "css": []})
+		if this_format == "pdf" or this_format == "html" or all_formats:
+			curr_format = "html" if this_format == "html" else "pdf"
+			this_format_jobs.append({"format": curr_format, "filename": f"{output_basename}.{curr_format}", "defaults": [yaml_pdf_path], "css": []})
+		if this_format == "pdf-6x9" or all_formats:
+			this_format_jobs.append({"format": "pdf-6x9", "filename": f"{output_basename}-6x9.pdf", "defaults": [yaml_pdf_path], "css": [css_pdf_6x9_path]})
+		if this_format == "html-chunked":
+			# Rendered as a single HTML file first, then split into pages in a folder.
+			this_format_jobs.append({"format": "html-chunked", "filename": f"{output_basename}-chunked-source.html", "folder": f"{output_basename}-html", "defaults": [yaml_pdf_path], "css": []})
+		
+		for job in this_format_jobs:
+			if job["filename"] in format_filenames:
+				continue
+			format_filenames.append(job["filename"])
+			job["command"] = pandoc_pre_args + [f'--defaults={path}' for path in job["defaults"]] + [f'--output={job["filename"]}'] + [f'--css={path}' for path in job["css"]] + pandoc_post_args
+			job["defaults"] = [yaml_shared_path] + job["defaults"]
+			job["css"] = extra_css + job["css"]
+			# pandoc server can't run a PDF engine, or accept arbitrary extra arguments.
+			job["server_unsupported"] = job["format"].startswith("pdf") or (extra_args is not None) or pandoc_verbose
+			format_jobs.append(job)
+
+	# Define the build stages. Each declares what it reads, so it can be skipped if none of that has changed since it last ran.
+	# This module holds the build code; this_script_path is usually just the build-book.py launcher, but hash both anyway.
+	script_version = content_hash(file_hash(os.path.abspath(__file__)), file_hash(this_script_path))
+	server_metadata = json_contents.copy()
+
+	def collate_stage(dep_outputs):
+		# Read all Markdown files, applying exclusions and checking for TKs.
+		documents = []
+		included_paths = []
+		files_with_tks = []
+		num_exclusions = 0
+		# Only look chapters up in the cache if there's something there to reuse.
+		use_chapter_cache = check_tks or any(excl[exclusion_scope_key] == scope_contents for excl in (exclusions_map or []))
+		try:
+			# Prefetch file contents concurrently, while consuming them here in the original sorted order.
+			import concurrent.futures
+			with concurrent.futures.ThreadPoolExecutor(max_workers=read_workers) as read_executor:
+				for file, text_contents in zip(files, read_executor.map(read_text_file, files)):
+					filename = os.path.basename(file)
+					file_path = os.path.dirname(file)
+					excluded = False
+					# Reuse contents-rule results and TK counts from any earlier build (of any book) which processed this chapter.
+					# Rules are recorded by pattern, after any metadata substitution, so each rule's result is keyed by what it depends on.
+					chapter_key = content_hash(tk_pattern, text_contents) if use_chapter_cache else None
+					chapter_cached = cache_read("chapters", chapter_key) if use_chapter_cache else None
+					chapter_info = json.loads(chapter_cached) if chapter_cached else {"matches": {}, "tks": None}
+					chapter_info_changed = False
+					if exclusions_map and len(exclusions_map) > 0:
+						for excl in exclusions_map:
+							if excl[source_key] in skipped_rules:
+								continue
+							
+							# Heed path filter if specified.
+							if excl[path_key] != path_any:
+								try:
+									filter_matched = rule_search(excl[source_key], excl[path_key], file_path)
+								except RuleBudgetExceeded:
+									rule_budget_exceeded(excl[source_key], excl[path_key])
+									continue
+								# Consider negation.
+								if negation_key in excl and path_key in excl[negation_key]:
+									filter_matched = not filter_matched
+								if not filter_matched:
+									# This file doesn't match this exclusion's path filter; skip to next exclusion.
+									continue
+							
+							# Run regexp search.
+							target_scope = filename
+							target_desc = "filename"
+							if excl[exclusion_scope_key] == scope_filepath:
+								target_scope = file_path
+								target_desc = "file path"
+							elif excl[exclusion_scope_key] == scope_fullpath:
+								target_scope = file
+								target_desc = "entire path"
+							elif excl[exclusion_scope_key] == scope_contents:
+								target_scope = text_contents
+								target_desc = "contents"
+							
+							try:
+								if excl[exclusion_scope_key] == scope_contents and excl[search_key] in chapter_info["matches"]:
+									found_match = chapter_info["matches"][excl[search_key]]
+									record_cached_rule_result(excl[source_key], found_match)
+								else:
+									found_match = rule_search(excl[source_key], excl[search_key], target_scope)
+									if excl[exclusion_scope_key] == scope_contents:
+										chapter_info["matches"][excl[search_key]] = bool(found_match)
+										chapter_info_changed = True
+							except RuleBudgetExceeded:
+								rule_budget_exceeded(excl[source_key], excl[search_key])
+								continue
+							# Consider negation.
+							if negation_key in excl and search_key in excl[negation_key]:
+								found_match = not found_match
+							
+							if (found_match and excl[exclusion_mode_key] == mode_exclude) or (not found_match and excl[exclusion_mode_key] == mode_include):
+								excluded = True
+								num_exclusions = num_exclusions + 1
+								message = ""
+								if comment_key in excl:
+									message = f"{excl[comment_key]}"
+								else:
+									message = f"\"{excl[search_key]}\""
+									if negation_key in excl and search_key in excl[negation_key]:
+										message = f"{message} (negated)"
+									if excl[path_key] != path_any:
+										message = f"{message}, path filter \"{excl[path_key]}\""
+										if negation_key in excl and path_key in excl[negation_key]:
+											message = f"{message} (negated)"
+								inform(f"- File excluded, as requested: {file} ({target_desc} {'matched' if found_match else 'did not match'} {'exclusion' if excl[exclusion_mode_key] == mode_exclude else 'inclusion'}: {message})")
+								break
+					
+					if not excluded:
+						documents.append(text_contents)
+						included_paths.append(file)
+						
+						if check_tks:
+							if chapter_info["tks"] is None:
+								chapter_info["tks"] = len(re.findall(tk_pattern, text_contents))
+								chapter_info_changed = True
+							num_tks = chapter_info["tks"]
+							if num_tks > 0:
+								files_with_tks.append(f"{filename} ({num_tks} TK{'s' if num_tks != 1 else ''})")
+					
+					if chapter_info_changed:
+						cache_write("chapters", chapter_key, json.dumps(chapter_info))
+						
+		except IOError as e:
+			inform(f"Couldn't read Markdown files: {e}", severity="error")
+			sys.exit(1)
+		return {"documents": documents, "paths": included_paths, "tks": files_with_tks, "num_exclusions": num_exclusions}
+
+	def collate_inputs(dep_outputs):
+		return {"script": script_version, "files": {path: file_signature(path) for path in files}, "exclusions": exclusions_map, "check tks": check_tks}
+
+	def check_collation_stage(dep_outputs):
+		# Report on the collated files and any TKs, and select the requested range of files for a draft build.
+		collated = dep_outputs["collate"]
+		num_exclusions = collated["num_exclusions"]
+		msg_excluded = ""
+		if num_exclusions > 0:
+			msg_excluded = f" ({num_exclusions} file{'s' if num_exclusions != 1 else ''} excluded)"
+		inform(f"{len(collated['documents'])} Markdown files read{msg_excluded}.", force=verbose_mode)
+		
+		if len(collated["documents"]) == 0:
+			inform(f"No files selected for building. Not continuing.", severity="error")
+			sys.exit(1)
+		elif verbose_mode:
+			for f in collated["paths"]:
+				inform(f"- {f}")
+		
+		if check_tks:
+			num_tks = len(collated["tks"])
+			if num_tks > 0:
+				files_with_tks_string = '\n'.join(['- ' + f for f in collated["tks"]])
+				inform(f"TKs are present in the following files:\n{files_with_tks_string}", severity="warning", force=check_tks)
+				if stop_on_tks:
+					inform("TKs were found and you requested to stop on TKs. Not continuing.", severity="error")
+					sys.exit(1)
+				else:
+					inform(f"(Continuing despite TKs.)", severity="warning", force=check_tks)
+			else:
+				inform(f"No TKs found.")
+		
+		range_start, range_end = 0, len(collated["documents"]) - 1
+		if draft_range:
+			relative_paths = [os.path.relpath(f, full_folder_path) for f in collated["paths"]]
+			range_start = next((i for i, f in enumerate(relative_paths) if re.search(draft_range[0], f)), None)
+			range_end = range_start
+			if range_start is not None and len(draft_range) > 1:
+				range_end = next((i for i, f in enumerate(relative_paths) if i >= range_start and re.search(draft_range[1], f)), None)
+			if range_start is None or range_end is None:
+				inform(f"No files match the requested draft range: {' to '.join(draft_range)}", severity="error")
+				sys.exit(1)
+			num_range_files = range_end - range_start + 1
+			inform(f"Draft range: {relative_paths[range_start]} to {relative_paths[range_end]} ({num_range_files} file{'s' if num_range_files != 1 else ''}).", force=True)
+		return [range_start, range_end]
+
+	def figuremark_stage(dep_outputs):
+		# Concatenate master file, processing FigureMark. Must be before TextIndex, in case of overlapping syntax.
+		# Returns a dict with keys text (the master file's contents), and context and offset (the whole book, and where
+		# text begins within it, for draft ranges; otherwise None and 0).
+		range_start, range_end = dep_outputs["check-collation"]
+		documents = dep_outputs["collate"]["documents"]
+		if draft_range:
+			# Process the whole book, marking the draft range so it can be found again afterwards.
+			book_contents = "\n".join(documents[:range_start] + [draft_range_start_marker] + documents[range_start:range_end + 1] + [draft_range_end_marker] + documents[range_end + 1:])
+		else:
+			book_contents = "\n".join(documents)
+		if process_figuremark:
+			figuremark_lib_path = os.path.join(os.path.dirname(this_script_path), "FigureMark/src/python/")
+			sys.path.append(figuremark_lib_path)
+			from figuremark import figuremark
+			inform(f"FigureMark processing enabled.")
+			# Convert the book as a whole, since FigureMark numbers figures (and their default IDs) across the entire document.
+			# (This stage's output is cached, so an unchanged book isn't converted again.)
+			book_contents = figuremark.convert(book_contents)
+		if not draft_range:
+			return {"text": book_contents, "context": None, "offset": 0}
+		
+		before, found_start, rest = book_contents.partition(draft_range_start_marker)
+		range_text, found_end, after = rest.partition(draft_range_end_marker)
+		if not (found_start and found_end):
+			inform(f"Couldn't find the draft range in FigureMark's output; partial tables of contents will only cover the draft range.", severity="warning")
+			return {"text": book_contents.replace(draft_range_start_marker, "").replace(draft_range_end_marker, ""), "context": None, "offset": 0}
+		# Each marker was joined to its neighbours with a newline; drop those extra newlines.
+		range_text = range_text[1:] if range_text.startswith("\n") else range_text
+		range_text = range_text[:-1] if range_text.endswith("\n") else range_text
+		after = after[1:] if after.startswith("\n") else after
+		return {"text": range_text, "context": before + range_text + after, "offset": len(before)}
+
+	def figuremark_inputs(dep_outputs):
+		figuremark_source_path = os.path.join(os.path.dirname(this_script_path), "FigureMark/src/python/figuremark/figuremark.py")
+		return {"script": script_version, "enabled": process_figuremark, "figuremark": file_hash(figuremark_source_path) if process_figuremark else ""}
+
+	def toc_stage(dep_outputs):
+		# Process ToC / Table of Contents. Must be before TextIndex, since TextIndex may HTMLify Markdown headings.
+		master_contents = dep_outputs["figuremark"]["text"]
+		if not should_process_toc:
+			return master_contents
+		# Draft builds keep the whole (FigureMark-processed) book as context, so partial ToCs match the full book's.
+		return process_toc(master_contents, dep_outputs["figuremark"]["context"], dep_outputs["figuremark"]["offset"])
+
+	def transformations_stage(dep_outputs):
+		# Process transformations. Must be before TextIndex, since TextIndex may HTMLify Markdown headings.
+		master_contents = dep_outputs["toc"]
+		if len(transformations) > 0:
+			inform("Transformations found. Performing:")
+		for transformation in transformations:
+			message = ""
+			if comment_key in transformation:
+				message = transformation[comment_key]
+			else:
+				message = f"Replace '{transformation[search_key]}' with '{transformation[replace_key]}'"
+			inform(f"- {message}")
+			try:
+				master_contents = rule_subn(transformation[source_key], transformation[search_key], transformation[replace_key], master_contents)
+			except RuleBudgetExceeded:
+				rule_budget_exceeded(transformation[source_key], transformation[search_key])
+		return master_contents
+
+	def textindex_stage(dep_outputs):
+		master_contents = dep_outputs["transformations"]
+		if not process_textindex:
+			return master_contents
+		textindex_lib_path = os.path.join(os.path.dirname(this_script_path), "TextIndex/")
+		sys.path.append(textindex_lib_path)
+		from textindex import textindex
+		inform(f"TextIndex processing enabled.")
+		index = textindex.TextIndex(master_contents)
+		return index.indexed_document()
+
+	def textindex_inputs(dep_outputs):
+		textindex_source_path = os.path.join(os.path.dirname(this_script_path), "TextIndex/textindex/textindex.py")
+		return {"script": script_version, "enabled": process_textindex, "textindex": file_hash(textindex_source_path) if process_textindex else ""}
+
+	def placeholders_stage(dep_outputs):
+		master_contents = dep_outputs["textindex"]
+		if placeholder_mode == "basic":
+			placeholder_delim = "%"
+			# Replace all occurrences of metadata placeholders in master_contents.
+			for key, value in json_contents.items():
+				#print(f"{key}: {value} [{type(value)}]")
+				master_contents = master_contents.replace(f"{placeholder_delim}{key}{placeholder_delim}", str(value))
+			
+			# Identify and warn about any remaining placeholders, i.e. for missing metadata keys.
+			placeholder_pattern = rf"(?<!{placeholder_delim})\W{placeholder_delim}([^{placeholder_delim}]+?){placeholder_delim}\W"
+			for placeholder_match in re.finditer(placeholder_pattern, master_contents):
+				meta_key = placeholder_match.group(1)
+				if meta_key not in json_contents:
+					inform(f"Can't replace placeholder '{meta_key}', because it has no value in metadata. Ignoring.", severity="warning")
+		
+		elif placeholder_mode == "templite":
+			try:
+				from templite import Templite
+				t = Templite(master_contents)
+				master_contents = t.render(**json_contents)
+			except ImportError as e:
+				inform(f"Couldn't find templite module: {e}", severity="warning")
+		
+		elif placeholder_mode == "jinja2":
+			try:
+				from jinja2 import Template
+				template = Template(master_contents)
+				master_contents = template.render(json_contents)
+			except ImportError as e:
+				inform(f"Couldn't find jinja2 for python3: {e}", severity="warning")
+		return master_contents
+
+	def draft_images_stage(dep_outputs):
+		# Use quick-loading images for drafts. Always runs, since it depends on the images' contents; the proxies themselves are cached.
+		return make_draft_image_proxies(dep_outputs["placeholders"])
+
+	final_text_stage = "draft-images" if draft_mode else "placeholders"
+
+	def write_master_stage(dep_outputs):
+		master_contents = dep_outputs[final_text_stage]
+		try:
+			inform(f"Saving collated master file: {master_filename}")
+			master_file = open(master_filename, 'w')
+			master_file.write(master_contents)
+			master_file.close()
+		except IOError as e:
+			inform(f"Couldn't save master file: {e}", severity="error")
+			sys.exit(1)
+		return content_hash(master_contents)
+
+	def format_output_hash(job):
+		# Identify a format's built output, or return an empty string if it's missing.
+		if job["format"] == "html-chunked":
+			page_paths = sorted(glob.glob(os.path.join(job["folder"], "*.html")))
+			return content_hash(*[file_hash(path) for path in page_paths]) if len(page_paths) > 0 else ""
+		return file_hash(job["filename"])
+
+	def format_stage(job):
+		def run(dep_outputs):
+			text = dep_outputs[final_text_stage]
+			server_port = ensure_pandoc_server(pandoc_server_port) if (use_pandoc_server and not job["server_unsupported"]) else None
+			estimate = estimate_job_memory(job, text)
+			for attempt in range(1, max_format_attempts + 1):
+				admitted = estimate
+				memory_limit = admit_job(job, admitted)
+				try:
+					run_format_job(job, server_port, text, server_metadata, memory_limit=memory_limit)
+					break
+				except FormatJobKilled as e:
+					if attempt == max_format_attempts or (memory_budget > 0 and estimate >= memory_budget):
+						inform(f"Couldn't build {job['format']} format with pandoc ({e}), probably for lack of memory. Try a larger --memory-budget.", severity="error")
+						sys.exit(1)
+					# Try again once there's room for it, reserving more memory.
+					estimate = min(estimate * 2, memory_budget) if memory_budget > 0 else estimate
+					inform(f"Building {job['format']} format was stopped ({e}), probably for lack of memory. Requeuing it with {estimate:,} MB.", severity="warning")
+				except Exception as e:
+					inform(f"Couldn't build {job['format']} format with pandoc: {e}", severity="error")
+					sys.exit(1)
+				finally:
+					release_job(admitted)
+			if optimise_output:
+				optimise_format_output(job)
+			output_hash = format_output_hash(job)
+			if output_hash == "":
+				# Never cache a format without its output.
+				inform(f"Couldn't find built {job['format']} format output.", severity="error")
+				sys.exit(1)
+			return output_hash
+		return run
+
+	def format_inputs(job):
+		def inputs(dep_outputs):
+			# Everything pandoc reads besides the master file: options files and the styles and templates they name,
+			# stylesheets, metadata, the cover, and images. The master file's own name is timestamped, so is left out.
+			resource_paths = list(job["defaults"]) + list(job["css"])
+			for defaults_path in job["defaults"]:
+				try:
+					defaults = read_pandoc_defaults(defaults_path)
+				except IOError:
+					continue
+				for key in ["css", "template", "epub-cover-image"]:
+					value = defaults.get(key, [])
+					resource_paths += value if isinstance(value, list) else [value]
+			if "cover-image" in json_contents:
+				resource_paths.append(json_contents["cover-image"])
+			resource_paths += re.findall(r"!\[[^\]]*\]\(<?([^)\s>]+)", dep_outputs[final_text_stage])
+			job_settings = {key: value for key, value in job.items() if key != "command"}
+			import shutil
+			pandoc_path = shutil.which("pandoc")
+			return {"script": script_version, "job": job_settings, "resources": {path: file_hash(path) for path in sorted(set(resource_paths))}, "metadata file": file_hash(full_metadata_path), "metadata": json_contents, "extra args": extra_args, "pandoc verbose": pandoc_verbose, "optimise": optimise_output, "pandoc": file_signature(pandoc_path) if pandoc_path else ""}
+		return inputs
+
+	build_stages = [
+		stage_node("collate", collate_stage, inputs=collate_inputs),
+		stage_node("check-collation", check_collation_stage, deps=["collate"], cacheable=False),
+		stage_node("figuremark", figuremark_stage, deps=["collate", "check-collation"], inputs=figuremark_inputs),
+		stage_node("toc", toc_stage, deps=["figuremark"], inputs=lambda dep_outputs: {"script": script_version, "enabled": should_process_toc, "draft range": draft_range}),
+		stage_node("transformations", transformations_stage, deps=["toc"], inputs=lambda dep_outputs: {"script": script_version, "transformations": transformations, "rule time budget": rule_time_budget, "rule budget action": rule_budget_action}),
+		stage_node("textindex", textindex_stage, deps=["transformations"], inputs=textindex_inputs),
+		stage_node("placeholders", placeholders_stage, deps=["textindex"], inputs=lambda dep_outputs: {"script": script_version, "mode": placeholder_mode, "metadata": json_contents}),
+	]
+	if draft_mode:
+		build_stages.append(stage_node("draft-images", draft_images_stage, deps=["placeholders"], cacheable=False))
+	build_stages.append(stage_node("write-master", write_master_stage, deps=[final_text_stage], cacheable=False))
+	# Start the hungriest formats first, so smaller ones can fill in around them.
+	for job in sorted(format_jobs, key=lambda job: format_memory_estimates.get(job["format"], format_memory_estimates["html"]), reverse=True):
+		# Format stages read the final text directly when using pandoc server, but always need the master file written.
+		build_stages.append(stage_node(f"format-{job['format']}", format_stage(job), deps=[final_text_stage, "write-master"], inputs=format_inputs(job), valid=lambda output, job=job: output != "" and format_output_hash(job) == output))
+
+	# Run the build stages, with independent stages (e.g. formats) running concurrently.
+	if explain_stages:
+		inform("Explaining build stages:", force=True)
+	try:
+		run_stages(build_stages, max_workers=build_jobs, explain=explain_stages)
+	finally:
+		if pandoc_server_process and not keep_pandoc_server:
+			stop_pandoc_server(pandoc_server_process)
+
+	# Remove temporary master file.
+	if not retain_collated_master:
+		inform(f"Deleting collated master file: {master_filename}")
+		try:
+			os.remove(master_filename)
+		except IOError as e:
+			inform(f"Couldn't delete master file: {e}", severity="error")
+			sys.exit(1)
+	else:
+		inform(f"Keeping collated master file, as requested: {master_filename}")
+
+	if report_costs or verbose_mode:
+		report_rule_costs()
+
+	# Keep the shared cache within its size limit.
+	if use_cache and cache_max_size > 0 and os.path.isdir(cache_folder_path):
+		num_removed, cache_size = prune_cache(cache_max_size)
+		if num_removed > 0:
+			inform(f"Removed {num_removed} least recently used cache entr{'ies' if num_removed != 1 else 'y'}, to keep the cache within {cache_max_size:,} MB ({cache_size:,} bytes).")
+	if report_cache or verbose_mode:
+		report_cache_stats()
+
+	inform("Done.")
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,126 @@
+#!/usr/bin/python
+
+# Usage: python make-zipapp.py [--output pandoc-novel.pyz]
+# Builds a single-file, directly-executable zipapp of build-book.py, bundling this folder's templates, styles,
+# and options files, the FigureMark and TextIndex submodules, and precompiled bytecode for all Python code.
+# Documentation: https://github.com/mattgemmell/pandoc-novel/blob/main/README.org
+
+import argparse
+import hashlib
+import importlib.util
+import os
+import py_compile
+import shutil
+import sys
+import tempfile
+import zipapp
+
+
+# --- Globals ---
+
+default_output_filename = "pandoc-novel.pyz"
+bundle_id_filename = "BUNDLE_ID"
+excluded_names = [".git", "__pycache__", ".DS_Store", os.path.basename(__file__), "run-benchmarks.py"]
+excluded_extensions = (".pyz", ".pyc")
+
+# The launcher unpacks the bundle once per version (since pandoc needs real files for its templates,
+# styles, and options), then runs build-book.py from there using its precompiled bytecode.
+launcher_source = '''# pandoc-novel zipapp launcher. Generated by make-zipapp.py.
+import importlib.util
+import marshal
+import os
+import shutil
+import sys
+import zipfile
+
+archive_path = os.path.dirname(os.path.abspath(__file__))
+with zipfile.ZipFile(archive_path) as archive:
+	bundle_id = archive.read("{bundle_id_filename}").decode("ascii").strip()
+	cache_root = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+	bundle_path = os.path.join(cache_root, "pandoc-novel", "zipapp", bundle_id)
+	if not os.path.isdir(bundle_path):
+		temp_path = f"{{bundle_path}}.{{os.getpid()}}.tmp"
+		archive.extractall(temp_path)
+		try:
+			os.replace(temp_path, bundle_path)
+		except OSError:
+			# Another build unpacked the same bundle first.
+			shutil.rmtree(temp_path, ignore_errors=True)
+
+script_path = os.path.join(bundle_path, "build-book.py")
+sys.argv[0] = script_path
+sys.path.insert(0, bundle_path)
+
+code = None
+try:
+	with open(importlib.util.cache_from_source(script_path), 'rb') as pyc_file:
+		pyc_data = pyc_file.read()
+	if pyc_data[:4] == importlib.util.MAGIC_NUMBER:
+		code = marshal.loads(pyc_data[16:])
+except (OSError, ValueError, EOFError):
+	pass
+if code is None:
+	# Bytecode was compiled for a different version of Python.
+	with open(script_path, 'r') as script_file:
+		code = compile(script_file.read(), script_path, "exec")
+exec(code, {{"__name__": "__main__", "__file__": script_path, "__builtins__": __builtins__}})
+'''
+
+# --- Functions ---
+
+def copy_bundle_files(source_folder, staging_folder):
+	# Copy everything the build script needs, skipping version control and stale bytecode.
+	def ignored(folder, names):
+		return [name for name in names if name in excluded_names or name.endswith(excluded_extensions)]
+	shutil.copytree(source_folder, staging_folder, ignore=ignored, dirs_exist_ok=True)
+
+def compile_bundle(staging_folder):
+	# Precompile all Python sources, using unchecked hashes so unpacking (which resets mtimes) doesn't invalidate them.
+	num_compiled = 0
+	for folder, subfolders, filenames in os.walk(staging_folder):
+		for filename in filenames:
+			if not filename.endswith(".py") or filename == "__main__.py":
+				continue
+			source_path = os.path.join(folder, filename)
+			try:
+				py_compile.compile(source_path, cfile=importlib.util.cache_from_source(source_path), doraise=True, invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH)
+				num_compiled += 1
+			except py_compile.PyCompileError as e:
+				print(f"[Warning]: Couldn't compile {os.path.relpath(source_path, staging_folder)}: {e.msg}")
+	return num_compiled
+
+def bundle_hash(staging_folder):
+	# Identify this bundle's contents, so each version unpacks to its own folder.
+	digest = hashlib.sha256()
+	for folder, subfolders, filenames in sorted(os.walk(staging_folder)):
+		subfolders.sort()
+		for filename in sorted(filenames):
+			file_path = os.path.join(folder, filename)
+			digest.update(os.path.relpath(file_path, staging_folder).encode("utf-8"))
+			with open(file_path, 'rb') as bundled_file:
+				digest.update(bundled_file.read())
+	return digest.hexdigest()[:16]
+
+# --- Main script begins ---
+
+parser = argparse.ArgumentParser(description="Build a single-file zipapp of build-book.py and its resources.")
+parser.add_argument('--output', '-o', help=f"[optional] Output filename (default {default_output_filename})", type=str, default=default_output_filename)
+parser.add_argument('--interpreter', help="[optional] Interpreter for the zipapp's shebang line (default '/usr/bin/env python3')", type=str, default="/usr/bin/env python3")
+args = parser.parse_args()
+
+publish_folder = os.path.dirname(os.path.abspath(__file__))
+for submodule in ["FigureMark", "TextIndex"]:
+	if not os.listdir(os.path.join(publish_folder, submodule)):
+		print(f"[Warning]: The {submodule} submodule is empty; run 'git submodule update --init' to bundle it.")
+
+with tempfile.TemporaryDirectory() as staging_folder:
+	copy_bundle_files(publish_folder, staging_folder)
+	num_compiled = compile_bundle(staging_folder)
+	bundle_id = bundle_hash(staging_folder)
+	with open(os.path.join(staging_folder, bundle_id_filename), 'w') as bundle_id_file:
+		bundle_id_file.write(bundle_id)
+	with open(os.path.join(staging_folder, "__main__.py"), 'w') as launcher_file:
+		launcher_file.write(launcher_source.format(bundle_id_filename=bundle_id_filename))
+	zipapp.create_archive(staging_folder, target=args.output, interpreter=args.interpreter, compressed=True)
+
+print(f"Built {args.output} (bundle {bundle_id}, {num_compiled} Python files precompiled for Python {sys.version_info.major}.{sys.version_info.minor}).")
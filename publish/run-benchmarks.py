@@ -0,0 +1,157 @@
+#!/usr/bin/python
+
+# Usage: python run-benchmarks.py <benchmark> [options]. Run with the "-h" flag for brief help.
+# Benchmarks for build-book.py, to track its performance over time.
+# Documentation: https://github.com/mattgemmell/pandoc-novel/blob/main/README.org
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+# --- Globals ---
+
+default_runs = 20
+default_num_headings = 20000
+build_script_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "build-book.py")
+build_module_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "build_book.py")
+# Headings, and the identifiers pandoc gives them, to check the anchor table against before timing it.
+expected_anchors = [
+	("# Scene", "scene"),
+	("# Scene", "scene-1"),
+	("# Scene 1", "scene-1"),
+	("# snake_case", "snake_case"),
+	("# _The_ **End** `now`", "the-end-now"),
+	("# Epilogue {#the-end .unlisted}", "the-end"),
+	("# A [linked](https://example.com) title[^1]", "a-linked-title"),
+	("# Closing hashes ##", "closing-hashes"),
+]
+
+# --- Functions ---
+
+def time_command(command, runs):
+	# Returns wall-clock times in milliseconds for running command, after one untimed warm-up run.
+	subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+	times = []
+	for run in range(runs):
+		start_time = time.perf_counter()
+		subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+		times.append((time.perf_counter() - start_time) * 1000)
+	return times
+
+def slowest_imports(command, count=5):
+	# Returns the (cumulative microseconds, module) of the slowest top-level imports made by command, including those
+	# made by build_book (which build-book.py imports, so its own time includes loading its bytecode).
+	result = subprocess.run([sys.executable, "-X", "importtime"] + command[1:], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+	imports = []
+	for line in result.stderr.splitlines():
+		fields = line.split("|")
+		# Top-level imports have no indentation before the module name, and build_book's imports are indented once.
+		if len(fields) == 3 and fields[1].strip().isdigit() and not fields[2].startswith("     "):
+			imports.append((int(fields[1]), fields[2].strip()))
+	return sorted(imports, reverse=True)[:count]
+
+def benchmark_startup(args):
+	# Time how long the build script takes to start up and exit, relative to the bare interpreter.
+	commands = [("interpreter only", [sys.executable, "-c", "pass"]), ("build-book.py --help", [sys.executable, build_script_path, "--help"])]
+	if args.zipapp:
+		commands.append((f"{os.path.basename(args.zipapp)} --help", [sys.executable, args.zipapp, "--help"]))
+
+	print(f"Startup time (median of {args.runs} runs, with minimum):")
+	for description, command in commands:
+		times = time_command(command, args.runs)
+		print(f"- {description}: {statistics.median(times):.1f} ms ({min(times):.1f} ms)")
+
+	print(f"Slowest imports of build-book.py and build_book:")
+	for microseconds, module in slowest_imports(commands[1][1]):
+		print(f"- {module}: {microseconds / 1000:.1f} ms")
+
+def load_build_functions():
+	# Returns the build script's module, whose functions can be used without running the build itself.
+	sys.path.insert(0, os.path.dirname(build_module_path))
+	import build_book
+	return build_book
+
+def make_headings_book(num_headings):
+	# Returns a synthetic book with num_headings headings, many of them duplicates (as with repeated scene titles).
+	lines = []
+	for heading_num in range(num_headings):
+		if heading_num % 20 == 0:
+			lines.append(f"# Chapter {heading_num // 20 + 1}: The *Long* Road -- Part {heading_num % 7}")
+		elif heading_num % 20 == 1:
+			lines.append("## Part One")
+		elif heading_num % 5 == 0:
+			lines.append(f"## “Interlude” [{heading_num}](#top) {{#interlude-{heading_num}}}")
+		else:
+			lines.append("### Scene")
+		lines.append("\nSome prose, which isn't a heading.\n")
+	return "\n".join(lines)
+
+def time_call(function, runs):
+	# Returns wall-clock times in milliseconds for calling function.
+	times = []
+	for run in range(runs):
+		start_time = time.perf_counter()
+		function()
+		times.append((time.perf_counter() - start_time) * 1000)
+	return times
+
+def check_anchors(build):
+	# Exits with an error if heading_anchor_table's anchors don't match those pandoc would assign.
+	anchor_table = build.heading_anchor_table("\n\n".join(heading for heading, anchor in expected_anchors))
+	mismatches = [f"{heading}: expected {anchor}, got {entry['anchor']}" for (heading, anchor), entry in zip(expected_anchors, anchor_table) if entry["anchor"] != anchor]
+	if len(anchor_table) != len(expected_anchors):
+		mismatches.append(f"expected {len(expected_anchors)} headings, found {len(anchor_table)}")
+	if mismatches:
+		print("Heading anchors don't match pandoc's:\n- " + "\n- ".join(mismatches))
+		sys.exit(1)
+	print(f"Heading anchors match pandoc's for {len(expected_anchors)} test headings.")
+
+def benchmark_slugs(args):
+	# Time slugging, heading-anchor tables, and ToC generation over a book with many headings.
+	build = load_build_functions()
+	check_anchors(build)
+	book = make_headings_book(args.headings)
+	titles = [f"Chapter {num}: The Long Road" for num in range(args.headings // 20)] + ["Scene"] * (args.headings - args.headings // 20)
+	# Three ToCs, as for a book with a full contents page, a short one, and a partial one.
+	middle = book.find("\n# Chapter", len(book) // 2) + 1
+	toc_book = "{toc}\n{toc depth=1}\n" + book[:middle] + "{toc depth=2}\n" + book[middle:]
+	
+	def slug_titles(slug_function):
+		for title in titles:
+			slug_function(title)
+	
+	def cold_anchor_table():
+		build.parse_heading_title.cache_clear()
+		build.heading_identifier.cache_clear()
+		build.heading_anchor_table(book)
+	
+	benchmarks = [
+		("string_to_slug, unmemoized", lambda: slug_titles(build.string_to_slug.__wrapped__)),
+		("string_to_slug, memoized", lambda: slug_titles(build.string_to_slug)),
+		("heading_anchor_table, cold", cold_anchor_table),
+		("heading_anchor_table, warm", lambda: build.heading_anchor_table(book)),
+		("process_toc, 3 ToCs", lambda: build.process_toc(toc_book)),
+	]
+	print(f"Slugs and anchors for {args.headings:,} headings (median of {args.runs} runs, with minimum):")
+	for description, function in benchmarks:
+		times = time_call(function, args.runs)
+		print(f"- {description}: {statistics.median(times):.1f} ms ({min(times):.1f} ms)")
+
+# --- Main script begins ---
+
+parser = argparse.ArgumentParser(description="Benchmarks for build-book.py.")
+subparsers = parser.add_subparsers(dest="benchmark", required=True)
+startup_parser = subparsers.add_parser("startup", help="Time the build script's startup, i.e. interpreter launch, imports, and argument parsing")
+startup_parser.add_argument('--runs', '-n', help=f"[optional] Number of timed runs (default {default_runs})", type=int, default=default_runs)
+startup_parser.add_argument('--zipapp', '-z', help="[optional] Also time a zipapp built by make-zipapp.py", type=str, default=None)
+startup_parser.set_defaults(run_benchmark=benchmark_startup)
+slugs_parser = subparsers.add_parser("slugs", help="Time slugging, heading-anchor tables, and ToC generation for a book with many headings")
+slugs_parser.add_argument('--runs', '-n', help=f"[optional] Number of timed runs (default {default_runs})", type=int, default=default_runs)
+slugs_parser.add_argument('--headings', help=f"[optional] Number of headings in the synthetic book (default {default_num_headings})", type=int, default=default_num_headings)
+slugs_parser.set_defaults(run_benchmark=benchmark_slugs)
+args = parser.parse_args()
+args.run_benchmark(args)